@@ -12,21 +12,109 @@ app_settings = {
         'db': None,
         'admin_url': None,
         'allow_registration': False,
-        'granted_scopes': []
+        'granted_scopes': [],
+        'import_batch_size': 500,
+        # seconds users are kept in the identifier cache, entries are
+        # invalidated on changes across nodes through redis
+        'user_cache_ttl': 60,
+        # seconds unknown logins are remembered
+        'user_cache_negative_ttl': 5,
+        'user_cache_negative_size': 10000,
+        # find_user results by id, username and email, ttl 0 disables
+        'find_user_cache': {
+            'size': 10000,
+            'ttl': 10
+        },
+        # preload recently active users into the identifier cache on
+        # startup, from a snapshot of cached logins written on shutdown
+        # when a file is configured
+        'warmup': {
+            'enabled': False,
+            'users': 1000,
+            'batch_size': 200,
+            'time_budget': 10,
+            'snapshot': None
+        },
+        # max ids per POST @users/@batch-get
+        'batch_get_size': 100,
+        # thread, process or inline
+        'password_executor': 'thread',
+        'password_executor_size': None,
+        # password chunks of a bulk import hashed at a time,
+        # defaults to half the cpu count
+        'bulk_hash_concurrency': None,
+        # argon2 time_cost, memory_cost, parallelism, hash_len, salt_len
+        'argon2': {},
+        # bound concurrent password hashing/verification
+        'password_admission': {
+            'max_active': None,
+            'queue_size': 100,
+            'max_wait': 5,
+            'retry_after': 1
+        },
+        # pooled connections used for hydra admin and recaptcha requests
+        'http': {
+            'limit': 100,
+            'limit_per_host': 0,
+            'dns_cache_ttl': 10,
+            'keepalive_timeout': 15,
+            'timeout': 30,
+            'connect_timeout': 5
+        },
+        # seconds between reloads of per scope user counts for @users/@stats
+        'stats': {
+            'refresh_interval': 300
+        },
+        # hydra admin api resilience
+        'admin': {
+            'timeout': 10,
+            # per endpoint overrides, ie: {'login': 5, 'consent': 5}
+            'timeouts': {},
+            # retries for idempotent GET requests
+            'retries': 2,
+            'retry_backoff': 0.1,
+            'retry_ratio': 0.1,
+            'max_retries': 10,
+            # GET results of login/consent challenges, 0 to disable
+            'challenge_cache_ttl': 1,
+            'challenge_cache_size': 1000,
+            'breaker': {
+                'error_threshold': 0.5,
+                'min_requests': 20,
+                'window': 100,
+                'reset_timeout': 30
+            }
+        }
     },
     'recaptcha': {
         'public': None,
         'private': None,
     },
-    'registration_key': None
+    'registration_key': None,
+    # [{"kid": optional, "priv": pem, "pub": pem}], the first one encrypts
+    'internal_keys': [],
+    'commands': {
+        'hydra-calibrate-argon2': 'guillotina_hydraidp.commands.CalibrateArgon2Command',  # noqa
+        'hydra-import-users': 'guillotina_hydraidp.commands.ImportUsersCommand'  # noqa
+    }
 }
 
 
+configure.permission(
+    'guillotina_hydraidp.ExportUsers', 'Export all user data')
+configure.grant(
+    permission='guillotina_hydraidp.ExportUsers',
+    role='guillotina.Manager')
+
+
 def includeme(root):
     """
     custom application initialization here
     """
     configure.scan('guillotina_hydraidp.api')
+    configure.scan('guillotina_hydraidp.identifier')
     configure.scan('guillotina_hydraidp.join')
+    configure.scan('guillotina_hydraidp.stats')
     configure.scan('guillotina_hydraidp.storage')
+    configure.scan('guillotina_hydraidp.warmup')
     configure.scan('guillotina_hydraidp.json_definitions')
@@ -1,42 +1,181 @@
+import asyncio
+import json
+import logging
 import os
+import time
+from typing import Any
+from typing import Dict
+from typing import Tuple
 from guillotina.event import notify
 from guillotina.events import UserLogin
 from guillotina.auth import authenticate_user
 
 import aiohttp
 import asyncpg
+from aiohttp.web import StreamResponse
 import jsonschema
 from guillotina import app_settings, configure
-from guillotina.auth.validators import check_password
 from guillotina.interfaces import IApplication
+from guillotina.interfaces import IInteraction
 from guillotina.response import (HTTPBadRequest, HTTPConflict, HTTPFound,
                                  HTTPNotFound, HTTPPreconditionFailed,
-                                 HTTPUnauthorized, Response)
+                                 HTTPServiceUnavailable, HTTPUnauthorized,
+                                 Response)
 from guillotina.utils import get_authenticated_user_id
 from guillotina_authentication import utils as auth_utils
+from guillotina_hydraidp import metrics
+from guillotina_hydraidp.caching import MISSING
+from guillotina_hydraidp.caching import LRUCache
+from guillotina_hydraidp.concurrency import CircuitBreaker
+from guillotina_hydraidp.concurrency import RetryBudget
+from guillotina_hydraidp.concurrency import SingleFlight
+from guillotina_hydraidp import stats
 from guillotina_hydraidp import utils
 from yarl import URL
 
 
+logger = logging.getLogger(__name__)
+
+
+ADMIN_BREAKER = None
+ADMIN_RETRY_BUDGET = None
+ADMIN_CACHE = None
+admin_flight = SingleFlight('hydra_admin')
+
+
+def get_admin_settings():
+    return app_settings['hydra'].get('admin') or {}
+
+
+def get_admin_breaker():
+    global ADMIN_BREAKER
+    if ADMIN_BREAKER is None:
+        settings = get_admin_settings().get('breaker') or {}
+        ADMIN_BREAKER = CircuitBreaker(
+            'hydra_admin',
+            error_threshold=settings.get('error_threshold', 0.5),
+            min_requests=settings.get('min_requests', 20),
+            window=settings.get('window', 100),
+            reset_timeout=settings.get('reset_timeout', 30))
+    return ADMIN_BREAKER
+
+
+def get_admin_retry_budget():
+    global ADMIN_RETRY_BUDGET
+    if ADMIN_RETRY_BUDGET is None:
+        settings = get_admin_settings()
+        ADMIN_RETRY_BUDGET = RetryBudget(
+            ratio=settings.get('retry_ratio', 0.1),
+            max_retries=settings.get('max_retries', 10))
+    return ADMIN_RETRY_BUDGET
+
+
+def get_admin_cache():
+    global ADMIN_CACHE
+    if ADMIN_CACHE is None:
+        settings = get_admin_settings()
+        ADMIN_CACHE = LRUCache(
+            'hydra_admin_cache',
+            max_size=settings.get('challenge_cache_size', 1000),
+            ttl=settings.get('challenge_cache_ttl', 1))
+    return ADMIN_CACHE
+
+
+async def _hydra_admin_request(method, url, **kwargs):
+    session = utils.get_http_session()
+    func = getattr(session, method.lower())
+    async with func(url, **kwargs) as resp:
+        if resp.status < 200 or resp.status > 302:
+            try:
+                content = await resp.json()
+            except Exception:
+                content = {
+                    'reason': await resp.text()
+                }
+            if resp.status == 404:
+                content['reason'] = 'Invalid configuration'
+            return resp.status, content
+        return resp.status, await resp.json()
+
+
 async def hydra_admin_request(method, path, **kwargs):
-    async with aiohttp.ClientSession() as session:
-        func = getattr(session, method.lower())
-        url = '{}/oauth2/auth/requests/{}'.format(
-            app_settings['hydra']['admin_url'].rstrip('/'),
-            path.strip('/')
-        )
-        async with func(url, **kwargs) as resp:
-            if resp.status < 200 or resp.status > 302:
-                try:
-                    content = await resp.json()
-                except Exception:
-                    content = {
-                        'reason': await resp.text()
-                    }
-                if resp.status == 404:
-                    content['reason'] = 'Invalid configuration'
-                raise Response(content=content, status=resp.status)
-            return await resp.json()
+    if method.lower() != 'get':
+        return await _call_hydra_admin(method, path, **kwargs)
+
+    # login/consent challenge lookups are often submitted twice by
+    # browsers: share concurrent calls and keep results very shortly
+    key = 'get:' + path.strip('/')
+    cache = get_admin_cache()
+    result = cache.get(key)
+    if result is MISSING:
+        result = await admin_flight.do(
+            key, _call_hydra_admin, method, path, **kwargs)
+        if cache.ttl:
+            cache.set(key, result)
+    return result
+
+
+async def _call_hydra_admin(method, path, **kwargs):
+    settings = get_admin_settings()
+    breaker = get_admin_breaker()
+    budget = get_admin_retry_budget()
+    url = '{}/oauth2/auth/requests/{}'.format(
+        app_settings['hydra']['admin_url'].rstrip('/'),
+        path.strip('/')
+    )
+    # timeouts can be configured per endpoint: login, consent, logout...
+    endpoint = path.strip('/').split('/')[0]
+    timeout = (settings.get('timeouts') or {}).get(
+        endpoint, settings.get('timeout', 10))
+    kwargs.setdefault('timeout', aiohttp.ClientTimeout(total=timeout))
+    retries = 0
+    if method.lower() == 'get':
+        # only idempotent lookups of login/consent requests are retried
+        retries = settings.get('retries', 2)
+
+    budget.deposit()
+    attempt = 0
+    while True:
+        if not breaker.allow():
+            metrics.incr('hydra_admin.short_circuited')
+            raise HTTPServiceUnavailable(content={
+                'reason': 'hydra admin unavailable'
+            }, headers={
+                'Retry-After': str(breaker.retry_after())
+            })
+        start = time.time()
+        try:
+            status, content = await _hydra_admin_request(
+                method, url, **kwargs)
+        except (asyncio.TimeoutError, aiohttp.ClientError):
+            logger.warning(f'Error calling hydra admin {method} {path}',
+                           exc_info=True)
+            status, content = None, {
+                'reason': 'hydra admin unavailable'
+            }
+        except Exception:
+            # do not leave a half-open breaker waiting on this call
+            breaker.record_failure()
+            raise
+        finally:
+            metrics.observe('hydra_admin.request_time', time.time() - start)
+
+        if status is not None and status < 500:
+            breaker.record_success()
+            if status < 200 or status > 302:
+                raise Response(content=content, status=status)
+            return content
+
+        breaker.record_failure()
+        if attempt < retries and budget.withdraw():
+            attempt += 1
+            metrics.incr('hydra_admin.retries')
+            await asyncio.sleep(
+                settings.get('retry_backoff', 0.1) * 2 ** (attempt - 1))
+            continue
+        if status is None:
+            raise HTTPServiceUnavailable(content=content)
+        raise Response(content=content, status=status)
 
 
 @configure.service(method='POST', name='@hydra-challenge',
@@ -47,7 +186,7 @@ async def get_challenge(context, request):
     url = URL(await auth_utils.get_authorization_url(
         client, callback=callback_url,
         scope=' '.join(app_settings['hydra']['granted_scopes'])))
-    async with aiohttp.ClientSession() as session:
+    async with utils.get_flow_session() as session:
         while 'login_challenge' not in url.query:
             async with session.get(url, allow_redirects=False) as resp:
                 if resp.status not in (200, 301, 302):
@@ -87,16 +226,24 @@ async def post_login(context, request):
         # username entered as email
         email = username
 
+    # credentials are checked against the primary, the find_user cache
+    # does not see password changes and removals made on other nodes
     if email is not None:
-        user = await utils.find_user(email=email.lower())
+        user = await utils.find_user(primary=True, email=email.lower())
     else:
-        user = await utils.find_user(username=username)
+        user = await utils.find_user(primary=True, username=username)
     if user is None:
         raise HTTPUnauthorized(content={
             'text': 'login failed'
         })
 
-    if check_password(user['password'], pw):
+    if await utils.check_user_password(user['password'], pw):
+        rehash = utils.password_needs_rehash(user['password'])
+        try:
+            await utils.record_login(user['id'], pw if rehash else None)
+        except Exception:
+            logger.warning(
+                f'Could not record login for {user["id"]}', exc_info=True)
         csrf_cookie = await utils.get_csrf_cookie_str(request)
         accept_request = await hydra_admin_request(
             'put', os.path.join('login', challenge, 'accept'),
@@ -129,7 +276,7 @@ async def post_login(context, request):
 
 async def _login_user(request, accept_data, user):
     # log user in directly now
-    async with aiohttp.ClientSession() as session:
+    async with utils.get_flow_session() as session:
         csrf = await utils.get_csrf_cookie_str(request)
         async with session.get(
                 accept_data['redirect_to'], headers={
@@ -413,6 +560,91 @@ async def post_user(context, request):
     return data
 
 
+_user_actions: Dict[Tuple[str, str], Tuple[Any, str]] = {}
+
+
+def user_action(method, name, permission):
+    '''
+    Register a view for `@users/@name`. Guillotina can only have one
+    variable route per method on `@users/`, actions are dispatched from it.
+    '''
+    def _register(func):
+        _user_actions[(method, name)] = (func, permission)
+        return func
+    return _register
+
+
+async def call_user_action(context, request, method, name):
+    try:
+        func, permission = _user_actions[(method, name)]
+    except KeyError:
+        raise HTTPNotFound(content={
+            'reason': f'{name} does not exist'
+        })
+    if not IInteraction(request).check_permission(permission, context):
+        raise HTTPUnauthorized(content={
+            'reason': f'Not allowed to call {name}'
+        })
+    return await func(context, request)
+
+
+@configure.service(
+    method='POST', name='@users/{action}',
+    permission='guillotina.AccessContent',
+    context=IApplication,
+    summary='Bulk user operations: @bulk')
+async def post_user_action(context, request):
+    return await call_user_action(
+        context, request, 'POST', request.matchdict['action'])
+
+
+@user_action('POST', '@bulk', 'guillotina.AddUsers')
+async def bulk_import_users(context, request):
+    '''
+    Import users from a ndjson body, one HydraUser per line
+    '''
+    return await utils.import_users(
+        request.content,
+        batch_size=app_settings['hydra'].get('import_batch_size', 500))
+
+
+@user_action('POST', '@batch-get', 'guillotina.GetUser')
+async def batch_get_users(context, request):
+    '''
+    Look up users by id in one query: {"ids": [...]}. Users are returned
+    in the requested order, unknown ids are listed in `missing`.
+    '''
+    data = await request.json()
+    ids = data.get('ids') if isinstance(data, dict) else None
+    if not isinstance(ids, list) or not all(
+            isinstance(userid, str) for userid in ids):
+        raise HTTPPreconditionFailed(content={
+            'reason': 'ids must be a list of user ids'
+        })
+    max_ids = app_settings['hydra'].get('batch_get_size', 100)
+    if len(ids) > max_ids:
+        raise HTTPPreconditionFailed(content={
+            'reason': f'At most {max_ids} ids can be requested'
+        })
+    users, missing = await utils.find_users_by_ids(ids)
+    for user in users:
+        user['@id'] = str(request.url.with_path(f'/@users/{user["id"]}'))
+    return {
+        'items': users,
+        'missing': missing
+    }
+
+
+def _is_merge_patch(request):
+    '''
+    `application/merge-patch+json` bodies are applied as a partial update:
+    `data` is merged, null values remove keys, and `add_scopes` /
+    `remove_scopes` change allowed_scopes atomically
+    '''
+    return request.headers.get('Content-Type', '').startswith(
+        'application/merge-patch+json')
+
+
 @configure.service(
     method='PATCH', name='@users/{id}',
     permission='guillotina.EditUsers',
@@ -434,12 +666,17 @@ async def post_user(context, request):
     })
 async def update_user(context, request):
     data = await request.json()
-    data['id'] = request.matchdict['id']
-    data = await utils.update_user(**data)
-    if 'password' in data:
-        del data['password']
-    data['@id'] = str(request.url.with_path(f'/@users/{data["id"]}'))
-    return data
+    if _is_merge_patch(request):
+        user = await utils.patch_user(request.matchdict['id'], data)
+    else:
+        data['id'] = request.matchdict['id']
+        user = await utils.update_user(**data)
+    if user is None:
+        raise HTTPNotFound(content={
+            'reason': 'User not found'
+        })
+    user['@id'] = str(request.url.with_path(f'/@users/{user["id"]}'))
+    return user
 
 
 @configure.service(
@@ -452,7 +689,33 @@ async def update_user(context, request):
         "in": "path"
     }])
 async def delete_user(context, request):
-    await utils.remove_user(request.matchdict['userid'])
+    user = await utils.remove_user(request.matchdict['userid'])
+    if user is None:
+        raise HTTPNotFound(content={
+            'reason': 'User not found'
+        })
+
+
+def _get_limit(request, default=utils.MAX_PAGE_SIZE):
+    try:
+        limit = int(request.url.query.get('limit', default))
+    except ValueError:
+        limit = 0
+    if limit < 1:
+        raise HTTPBadRequest(content={
+            'reason': 'invalid limit'
+        })
+    return min(limit, utils.MAX_PAGE_SIZE)
+
+
+def _page_response(request, items, output, limit):
+    headers = {}
+    if len(items) > 0 and len(items) == limit:
+        next_cursor = items[-1]['id']
+        headers['X-Next-Cursor'] = next_cursor
+        headers['Link'] = '<{}>; rel="next"'.format(
+            request.url.update_query(cursor=next_cursor))
+    return Response(content=output, headers=headers)
 
 
 @configure.service(
@@ -460,6 +723,21 @@ async def delete_user(context, request):
     permission='guillotina.ListUsers',
     context=IApplication,
     summary='Get users',
+    parameters=[{
+        "name": "cursor",
+        "in": "query",
+        "type": "string",
+        "description": "X-Next-Cursor header value of the previous page"
+    }, {
+        "name": "limit",
+        "in": "query",
+        "type": "integer"
+    }, {
+        "name": "format",
+        "in": "query",
+        "type": "string",
+        "description": "ndjson to stream all users"
+    }],
     responses={
         "200": {
             "schema": {
@@ -472,14 +750,130 @@ async def delete_user(context, request):
         }
     })
 async def get_users(context, request):
+    if request.url.query.get('format') == 'ndjson':
+        return await _stream_users(request)
+
+    limit = _get_limit(request)
+    items = await utils.find_users(
+        limit=limit, cursor=request.url.query.get('cursor') or None)
     output = []
-    for item in await utils.find_users():
+    for item in items:
         output.append({
             'id': item['id'],
             'username': item['username'],
             '@id': str(request.url.with_path(f'/@users/{item["id"]}'))
         })
-    return output
+    return _page_response(request, items, output, limit)
+
+
+@user_action('GET', '@search', 'guillotina.ListUsers')
+async def search_users(context, request):
+    '''
+    ?scope=a&scope=b: users with all the scopes
+    ?data={"foo": "bar"}: users whose data contains the json object
+    ?username=&email=: prefix search, or substring with match=contains
+    '''
+    query = request.url.query
+    match = query.get('match', 'prefix')
+    if match not in ('prefix', 'contains'):
+        raise HTTPBadRequest(content={
+            'reason': 'match must be prefix or contains'
+        })
+    data = None
+    if query.get('data'):
+        try:
+            data = json.loads(query['data'])
+        except ValueError:
+            raise HTTPBadRequest(content={
+                'reason': 'data must be a json object'
+            })
+    limit = _get_limit(request, 100)
+    items = await utils.search_users(
+        scopes=query.getall('scope', []),
+        data=data,
+        username=query.get('username'),
+        email=query.get('email'),
+        match=match,
+        limit=limit,
+        cursor=query.get('cursor') or None)
+    output = []
+    for item in items:
+        item = dict(item)
+        item['@id'] = str(request.url.with_path(f'/@users/{item["id"]}'))
+        output.append(item)
+    return _page_response(request, items, output, limit)
+
+
+@user_action('GET', '@stats', 'guillotina.ListUsers')
+async def user_stats(context, request):
+    '''
+    User totals from planner estimates and per scope counts,
+    ?exact=true counts rows and reloads the scope counts
+    '''
+    exact = request.url.query.get('exact') in ('true', '1')
+    return await stats.get_user_stats(exact=exact)
+
+
+async def _write_ndjson(resp, items, chunk_size=500):
+    chunk = []
+    async for item in items:
+        chunk.append(json.dumps(item))
+        if len(chunk) >= chunk_size:
+            # write waits for the transport to drain
+            await resp.write(('\n'.join(chunk) + '\n').encode('utf-8'))
+            chunk = []
+    if chunk:
+        await resp.write(('\n'.join(chunk) + '\n').encode('utf-8'))
+
+
+async def _stream_users(request, chunk_size=500):
+    resp = StreamResponse(headers={
+        'Content-Type': 'application/x-ndjson'
+    })
+    await resp.prepare(request)
+
+    async def _items():
+        async for item in utils.iter_users(batch_size=chunk_size):
+            yield {
+                'id': item['id'],
+                'username': item['username'],
+                '@id': str(request.url.with_path(f'/@users/{item["id"]}'))
+            }
+
+    await _write_ndjson(resp, _items(), chunk_size)
+    await resp.write_eof()
+    return resp
+
+
+@user_action('GET', '@export', 'guillotina_hydraidp.ExportUsers')
+async def export_users(context, request):
+    '''
+    Stream all users as ndjson or csv, password hashes are only
+    included with `include_password=true`
+    '''
+    fmt = request.url.query.get('format', 'ndjson')
+    if fmt not in ('ndjson', 'csv'):
+        raise HTTPBadRequest(content={
+            'reason': 'format must be ndjson or csv'
+        })
+    columns = utils.USER_COLUMNS
+    if request.url.query.get('include_password') != 'true':
+        columns = tuple(c for c in columns if c != 'password')
+
+    resp = StreamResponse(headers={
+        'Content-Type': 'text/csv' if fmt == 'csv' else 'application/x-ndjson',
+        'Content-Disposition': f'attachment; filename="users.{fmt}"'
+    })
+    await resp.prepare(request)
+    if fmt == 'csv':
+        await utils.copy_users(resp.write, columns)
+    else:
+        async def _items():
+            async for row in utils.iter_users(columns=columns):
+                yield dict(row)
+        await _write_ndjson(resp, _items())
+    await resp.write_eof()
+    return resp
 
 
 @configure.service(
@@ -501,6 +895,8 @@ async def get_users(context, request):
     })
 async def get_user(context, request):
     userid = request.matchdict['userid']
+    if userid.startswith('@'):
+        return await call_user_action(context, request, 'GET', userid)
     user = await utils.find_user(id=userid)
     if user is not None:
         del user['password']
@@ -598,14 +994,25 @@ async def edit_user(context, request):
             'reason': 'not a valid user'
         })
 
-    user = await utils.find_user(id=userid)
+    for key in ('@id', 'id', 'username'):
+        if key in data:
+            del data[key]
+    if _is_merge_patch(request):
+        user = await utils.patch_user(userid, data)
+    else:
+        data['id'] = userid
+        user = await utils.update_user(**data)
     if user is None:
         raise HTTPPreconditionFailed(content={
             'reason': 'Not a valid user'
         })
+    return user
 
-    data['id'] = userid
-    for key in ('@id', 'username'):
-        if key in data:
-            del data[key]
-    await utils.update_user(**data)
+
+@configure.service(
+    method='GET', name='@hydra-metrics',
+    permission='guillotina.ReadConfiguration',
+    context=IApplication,
+    summary='Metrics of this worker process')
+async def get_metrics(context, request):
+    return metrics.get_metrics()
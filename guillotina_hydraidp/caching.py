@@ -0,0 +1,54 @@
+import collections
+import time
+
+from guillotina_hydraidp import metrics
+
+
+MISSING = object()
+
+
+class LRUCache:
+    '''
+    Size bounded in-process cache where entries also expire after `ttl`
+    seconds. Hits and misses are counted as `<name>.hits` and `<name>.misses`
+    metrics.
+    '''
+
+    def __init__(self, name, max_size=1000, ttl=60):
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = collections.OrderedDict()
+        metrics.register_gauge(f'{name}.size', lambda: len(self._data))
+
+    def get(self, key, default=MISSING):
+        try:
+            expires, value = self._data[key]
+        except KeyError:
+            metrics.incr(f'{self.name}.misses')
+            return default
+        if expires < time.monotonic():
+            del self._data[key]
+            metrics.incr(f'{self.name}.misses')
+            return default
+        self._data.move_to_end(key)
+        metrics.incr(f'{self.name}.hits')
+        return value
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        self._data[key] = (time.monotonic() + ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+            metrics.incr(f'{self.name}.evictions')
+
+    def delete(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
@@ -0,0 +1,84 @@
+import itertools
+import json
+import time
+
+from guillotina.commands import Command
+from guillotina_hydraidp import utils
+
+
+class CalibrateArgon2Command(Command):
+    description = 'Measure argon2 hash/verify latency per parameter set'
+
+    def get_parser(self):
+        parser = super().get_parser()
+        parser.add_argument('--target-ms', type=float, default=50,
+                            help='Wanted verify latency in milliseconds')
+        parser.add_argument('--iterations', type=int, default=10)
+        parser.add_argument('--time-cost', type=int, nargs='+',
+                            default=[1, 2, 3, 4])
+        parser.add_argument('--memory-cost', type=int, nargs='+',
+                            default=[51200, 102400, 204800])
+        parser.add_argument('--parallelism', type=int, nargs='+',
+                            default=[2, 4, 8])
+        return parser
+
+    def measure(self, params, iterations):
+        token = utils.hash_argon2_password('calibration', params=params)
+        start = time.time()
+        for _ in range(iterations):
+            utils.hash_argon2_password('calibration', params=params)
+        hash_ms = (time.time() - start) / iterations * 1000
+        start = time.time()
+        for _ in range(iterations):
+            utils.check_argon2_password(token, 'calibration')
+        verify_ms = (time.time() - start) / iterations * 1000
+        return hash_ms, verify_ms
+
+    def run(self, arguments, settings, app):
+        print(f'Configured: {dict(utils.get_argon2_params()) or "defaults"}')
+        print('time_cost memory_cost parallelism   hash ms  verify ms')
+        best = None
+        for time_cost, memory_cost, parallelism in itertools.product(
+                arguments.time_cost, arguments.memory_cost,
+                arguments.parallelism):
+            params = (
+                ('memory_cost', memory_cost),
+                ('parallelism', parallelism),
+                ('time_cost', time_cost))
+            hash_ms, verify_ms = self.measure(params, arguments.iterations)
+            print(f'{time_cost:>9} {memory_cost:>11} {parallelism:>11} '
+                  f'{hash_ms:>9.1f} {verify_ms:>10.1f}')
+            if verify_ms <= arguments.target_ms and (
+                    best is None or verify_ms > best[1]):
+                best = (params, verify_ms)
+
+        if best is None:
+            print(f'No parameter set verifies under {arguments.target_ms}ms')
+        else:
+            print(f'Closest to {arguments.target_ms}ms target: '
+                  f'{dict(best[0])} ({best[1]:.1f}ms)')
+
+
+class ImportUsersCommand(Command):
+    description = 'Import users from a ndjson file'
+
+    def get_parser(self):
+        parser = super().get_parser()
+        parser.add_argument('file', help='ndjson file, one user per line')
+        parser.add_argument('--batch-size', type=int, default=500)
+        return parser
+
+    async def read_lines(self, filename):
+        with open(filename) as fi:
+            for line in fi:
+                yield line
+
+    async def run(self, arguments, settings, app):
+        start = time.time()
+        result = await utils.import_users(
+            self.read_lines(arguments.file), batch_size=arguments.batch_size)
+        for error in result['errors']:
+            print(json.dumps(error))
+        print(f'Created {result["created"]} users with '
+              f'{len(result["errors"])} errors in '
+              f'{time.time() - start:.1f} seconds')
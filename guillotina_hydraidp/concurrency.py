@@ -0,0 +1,167 @@
+import asyncio
+import collections
+import time
+
+from guillotina.response import HTTPServiceUnavailable
+from guillotina.response import HTTPTooManyRequests
+from guillotina_hydraidp import metrics
+
+
+class AdmissionLimiter:
+    '''
+    Bounds the number of concurrent operations. Callers past `max_active`
+    wait in a queue of `queue_size` for at most `max_wait` seconds, after
+    that the request is shed with a 429 (queue full) or 503 (waited too long)
+    '''
+
+    def __init__(self, name, max_active, queue_size, max_wait,
+                 retry_after=1, loop=None):
+        self.name = name
+        self.max_active = max_active
+        self.queue_size = queue_size
+        self.max_wait = max_wait
+        self.retry_after = retry_after
+        self.loop = loop or asyncio.get_event_loop()
+        self.active = 0
+        self.waiting = 0
+        self._semaphore = asyncio.Semaphore(max_active)
+
+    def reject(self, response_class, reason):
+        metrics.incr(f'{self.name}.rejected')
+        raise response_class(content={
+            'reason': reason
+        }, headers={
+            'Retry-After': str(self.retry_after)
+        })
+
+    async def __aenter__(self):
+        if self._semaphore.locked() and self.waiting >= self.queue_size:
+            self.reject(HTTPTooManyRequests, 'Too many concurrent requests')
+        self.waiting += 1
+        start = time.time()
+        try:
+            await asyncio.wait_for(
+                self._semaphore.acquire(), self.max_wait)
+        except asyncio.TimeoutError:
+            self.reject(HTTPServiceUnavailable, 'Server busy')
+        finally:
+            self.waiting -= 1
+            metrics.observe(f'{self.name}.queue_time', time.time() - start)
+        self.active += 1
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.active -= 1
+        self._semaphore.release()
+
+
+class CircuitBreaker:
+    '''
+    Fails fast once the error rate over the last `window` calls crosses
+    `error_threshold`. After `reset_timeout` seconds one trial call is let
+    through, closing the breaker again if it succeeds.
+    '''
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, name, error_threshold=0.5, min_requests=20,
+                 window=100, reset_timeout=30):
+        self.name = name
+        self.error_threshold = error_threshold
+        self.min_requests = min_requests
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.opened_at = None
+        self._results = collections.deque(maxlen=window)
+        self._trial_running = False
+        metrics.register_gauge(f'{name}.breaker_state', lambda: self.state)
+
+    def allow(self):
+        if self.state == self.OPEN:
+            if time.time() - self.opened_at < self.reset_timeout:
+                return False
+            self.state = self.HALF_OPEN
+            self._trial_running = False
+        if self.state == self.HALF_OPEN:
+            if self._trial_running:
+                return False
+            self._trial_running = True
+        return True
+
+    def retry_after(self):
+        if self.opened_at is None:
+            return 0
+        return max(1, int(self.reset_timeout - (time.time() - self.opened_at)))
+
+    def open(self):
+        self.state = self.OPEN
+        self.opened_at = time.time()
+        self._results.clear()
+        metrics.incr(f'{self.name}.breaker_opened')
+
+    def record_success(self):
+        if self.state == self.HALF_OPEN:
+            self.state = self.CLOSED
+            self.opened_at = None
+        self._results.append(True)
+
+    def record_failure(self):
+        metrics.incr(f'{self.name}.failures')
+        if self.state == self.HALF_OPEN:
+            self.open()
+            return
+        self._results.append(False)
+        if len(self._results) >= self.min_requests:
+            errors = self._results.count(False)
+            if errors / len(self._results) >= self.error_threshold:
+                self.open()
+
+
+class RetryBudget:
+    '''
+    Token bucket for retries so they can not multiply load on a struggling
+    service: every call earns `ratio` of a retry, at most `max_retries`
+    can be saved up.
+    '''
+
+    def __init__(self, ratio=0.1, max_retries=10):
+        self.ratio = ratio
+        self.max_retries = max_retries
+        self.tokens = float(max_retries)
+
+    def deposit(self):
+        self.tokens = min(self.tokens + self.ratio, self.max_retries)
+
+    def withdraw(self):
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class SingleFlight:
+    '''
+    Concurrent calls with the same key share the result of one call
+    '''
+
+    def __init__(self, name):
+        self.name = name
+        self._calls = {}
+
+    async def do(self, key, func, *args, **kwargs):
+        future = self._calls.get(key)
+        if future is not None:
+            metrics.incr(f'{self.name}.coalesced')
+            return await asyncio.shield(future)
+
+        future = asyncio.ensure_future(func(*args, **kwargs))
+        self._calls[key] = future
+        try:
+            # shielded so waiters still get a result if the caller that
+            # started the call is cancelled
+            return await asyncio.shield(future)
+        finally:
+            if self._calls.get(key) is future:
+                del self._calls[key]
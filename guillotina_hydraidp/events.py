@@ -16,13 +16,18 @@ class UserCreatedEvent:
 
 @implementer(IUserModifiedEvent)
 class UserModifiedEvent:
-    def __init__(self, id_, data):
+    def __init__(self, id_, data, previous_scopes=None,
+                 previous_username=None):
         self.id = id_
         self.data = data
+        # values before the change, when scopes or username were modified
+        self.previous_scopes = previous_scopes
+        self.previous_username = previous_username
 
 
 @implementer(IUserRemovedEvent)
 class UserRemovedEvent:
-    def __init__(self, id_, username):
+    def __init__(self, id_, username, allowed_scopes=None):
         self.id = id_
         self.username = username
+        self.allowed_scopes = allowed_scopes
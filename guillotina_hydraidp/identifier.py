@@ -1,8 +1,25 @@
+import collections
 import logging
+import math
+import sys
+import time
+import uuid
 
+import aioredis
+from guillotina import app_settings, configure
 from guillotina.auth.users import GuillotinaUser
+from guillotina.component import query_utility
 from guillotina_rediscache import cache
+from guillotina_rediscache import serialize
+from guillotina_rediscache.interfaces import IRedisChannelUtility
+from guillotina_hydraidp import metrics
 from guillotina_hydraidp import utils
+from guillotina_hydraidp.caching import MISSING
+from guillotina_hydraidp.caching import LRUCache
+from guillotina_hydraidp.concurrency import SingleFlight
+from guillotina_hydraidp.interfaces import IUserCreatedEvent
+from guillotina_hydraidp.interfaces import IUserModifiedEvent
+from guillotina_hydraidp.interfaces import IUserRemovedEvent
 from guillotina_authentication.identifier import OAuthClientIdentifier
 
 logger = logging.getLogger(__name__)
@@ -11,34 +28,209 @@ USER_CACHE_DURATION = 60 * 1
 NON_IAT_VERIFY = {
     'verify_iat': False,
 }
+# bumped on every local invalidation so lookups that started before it
+# do not cache what they read
+_invalidations = 0
+# logins that do not exist, per worker
+NEGATIVE_CACHE = None
+user_flight = SingleFlight('user_cache')
+
+
+def get_user_cache_duration():
+    return app_settings['hydra'].get('user_cache_ttl', USER_CACHE_DURATION)
+
+
+def get_negative_cache():
+    global NEGATIVE_CACHE
+    if NEGATIVE_CACHE is None:
+        NEGATIVE_CACHE = LRUCache(
+            'user_cache_negative',
+            max_size=app_settings['hydra'].get(
+                'user_cache_negative_size', 10000),
+            ttl=app_settings['hydra'].get('user_cache_negative_ttl', 5))
+    return NEGATIVE_CACHE
+
+
+def get_user_cache_key(login, period=None):
+    '''
+    Users are cached per login for the current period of
+    `hydra.user_cache_ttl` seconds
+    '''
+    if period is None:
+        period = math.ceil(time.time() / get_user_cache_duration())
+    return f'hydra-user-{login}-{period}'
+
+
+def get_user_cache_keys(login):
+    # neighbour periods too, clocks of other nodes can be off
+    period = math.ceil(time.time() / get_user_cache_duration())
+    return [get_user_cache_key(login, period + offset)
+            for offset in (-1, 0, 1)]
+
+
+async def publish_invalidation(keys):
+    '''
+    Other nodes remove the keys from their memory cache, using the
+    guillotina_rediscache updates channel
+    '''
+    if query_utility(IRedisChannelUtility) is None:
+        return
+    try:
+        pool = await cache.get_redis_pool()
+        await aioredis.Redis(pool).publish(
+            app_settings['redis']['updates_channel'], serialize.dumps({
+                'tid': uuid.uuid4().hex,
+                'keys': keys,
+                'push': {}
+            }))
+    except Exception:
+        logger.warning('Error publishing user cache invalidation',
+                       exc_info=True)
+
+
+async def invalidate_user(*logins):
+    global _invalidations
+    _invalidations += 1
+    store = cache.get_memory_cache()
+    negative_cache = get_negative_cache()
+    keys = []
+    for login in logins:
+        negative_cache.delete(login)
+        keys.extend(get_user_cache_keys(login))
+    for key in keys:
+        if key in store:
+            del store[key]
+    metrics.incr('user_cache.invalidations', len(logins))
+    await publish_invalidation(keys)
+
+
+@configure.subscriber(for_=IUserCreatedEvent)
+async def user_created(event):
+    global _invalidations
+    _invalidations += 1
+    # fullname is the username
+    get_negative_cache().delete(event.fullname)
+
+
+@configure.subscriber(for_=IUserModifiedEvent)
+async def user_modified(event):
+    logins = {event.data.get('username'), event.previous_username}
+    logins.discard(None)
+    if logins:
+        await invalidate_user(*logins)
+
+
+@configure.subscriber(for_=IUserRemovedEvent)
+async def user_removed(event):
+    if event.username is not None:
+        await invalidate_user(event.username)
+
+
+# tokens validated with the password of the user
+PASSWORD_TOKEN_TYPES = ('basic', 'wstoken')
+
+
+class CachedUser(collections.namedtuple(
+        'CachedUser', ('id', 'scopes', 'roles'))):
+    '''
+    What authorization needs of a user, kept in the cache instead of a
+    GuillotinaUser. `roles` is a tuple of (container, roles, permissions)
+    computed once from the scopes, strings are interned so they are shared
+    between users. Scopes without container (`role:X`) are stored with
+    container None and apply everywhere, root included.
+    '''
+    __slots__ = ()
+
+    @classmethod
+    def from_user_data(cls, user_data):
+        scopes = tuple(sys.intern(scope)
+                       for scope in user_data['allowed_scopes'] or [])
+        by_container = collections.OrderedDict()
+        for scope in scopes:
+            split = scope.split(':')
+            if len(split) not in (2, 3) or \
+                    split[-2] not in ('role', 'permission'):
+                continue
+            container = sys.intern(split[0]) if len(split) == 3 else None
+            container_roles = by_container.setdefault(
+                container, {'role': [], 'permission': []})
+            container_roles[split[-2]].append(sys.intern(split[-1]))
+        return cls(
+            user_data['username'],
+            scopes,
+            tuple((container, tuple(values['role']),
+                   tuple(values['permission']))
+                  for container, values in by_container.items()))
+
+    def get_user(self, container_id):
+        '''
+        GuillotinaUser with the roles and permissions for the container
+        and the ones without container, only those on root
+        '''
+        user = GuillotinaUser(user_id=self.id)
+        for container, roles, permissions in self.roles:
+            if container is None or container == container_id:
+                for role in roles:
+                    user._roles[role] = 1
+                for permission in permissions:
+                    user._permissions[permission] = 1
+        return user
 
 
 class HydraDBUserIdentifier(OAuthClientIdentifier):
 
+    def get_user_cache_key(self, login):
+        return get_user_cache_key(login)
+
+    async def get_password_user(self, user_id, container_id):
+        '''
+        Basic and wstoken auth validators check the password hash, it is
+        not kept in the cache so these users are looked up every time, on
+        the primary to see password changes made on other nodes
+        '''
+        user_data = await utils.find_user(primary=True, username=user_id)
+        if user_data is None:
+            return
+        user = CachedUser.from_user_data(user_data).get_user(container_id)
+        user.password = user_data['password']
+        return user
+
     async def get_user(self, token):
-        cache_key = self.get_user_cache_key(token['id'])
+        user_id = token.get('id')
+        if user_id is None:
+            return
+
+        container_id = getattr(self.request, '_container_id', None)
+        if token.get('type') in PASSWORD_TOKEN_TYPES:
+            return await self.get_password_user(user_id, container_id)
+
+        cache_key = self.get_user_cache_key(user_id)
         store = cache.get_memory_cache()
         try:
-            return store[cache_key]
+            cached = store[cache_key]
+            metrics.incr('user_cache.hits')
+            return cached.get_user(container_id)
         except KeyError:
             pass
 
-        user_id = token.get('id')
-        if user_id is None:
+        negative_cache = get_negative_cache()
+        if negative_cache.get(user_id) is not MISSING:
+            metrics.incr('user_cache.negatives')
             return
 
-        user_data = await utils.find_user(username=user_id)
+        metrics.incr('user_cache.misses')
+        invalidations = _invalidations
+        # concurrent misses for the same login share one query. Kept for
+        # user_cache_ttl, so it is read from the primary and not from the
+        # find_user cache, neither sees changes made on other nodes.
+        user_data = await user_flight.do(
+            user_id, utils.find_user, primary=True, username=user_id)
+        if user_data is None:
+            if invalidations == _invalidations:
+                negative_cache.set(user_id, True)
+            return
 
-        user = GuillotinaUser(
-            user_id=user_data['username'],
-            properties=user_data['data'])
-        user.password = user_data['password']
-        # in oauth context, user can choose to only grant subset of all
-        # available. In this context, we give them access to everything
-        # on the container
-        self.apply_scope(user, {
-            'allowed_scopes': user_data['allowed_scopes'],
-            'scope': user_data['allowed_scopes'],
-        })
-        store[cache_key] = user
-        return user
+        cached = CachedUser.from_user_data(user_data)
+        if invalidations == _invalidations:
+            store[cache_key] = cached
+        return cached.get_user(container_id)
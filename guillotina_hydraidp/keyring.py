@@ -0,0 +1,87 @@
+import collections
+
+from jwcrypto import jwe
+from jwcrypto import jwk
+
+
+class Keyring:
+    '''
+    JWE keys indexed by kid, the key thumbprint unless one is given.
+    The first key encrypts, every key can decrypt. To rotate, add the new
+    key first and remove the old one once its payloads are not used
+    anymore.
+    '''
+
+    alg = 'RSA-OAEP-256'
+    enc = 'A256CBC-HS512'
+
+    def __init__(self, keys=()):
+        self._keys = collections.OrderedDict()
+        self._headers = {}
+        for key in keys:
+            self.add(key)
+
+    @classmethod
+    def from_settings(cls, settings):
+        '''
+        settings is a list of {"kid", "priv", "pub"} with pem encoded keys,
+        a public key is enough to encrypt
+        '''
+        keyring = cls()
+        for key_settings in settings or []:
+            pem = key_settings.get('priv') or key_settings.get('pub')
+            if isinstance(pem, str):
+                pem = pem.encode('utf-8')
+            keyring.add(jwk.JWK.from_pem(pem), key_settings.get('kid'))
+        return keyring
+
+    def add(self, key, kid=None):
+        kid = kid or key.get('kid')
+        if not kid:
+            kid = key.thumbprint()
+        self._keys[kid] = key
+        self._headers[kid] = {
+            'alg': self.alg,
+            'enc': self.enc,
+            'typ': 'JWE',
+            'kid': kid,
+        }
+
+    def remove(self, kid):
+        del self._keys[kid]
+        del self._headers[kid]
+
+    def get(self, kid):
+        return self._keys.get(kid)
+
+    @property
+    def current_kid(self):
+        return next(iter(self._keys), None)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def encrypt(self, payload):
+        kid = self.current_kid
+        if kid is None:
+            raise jwe.InvalidJWEOperation('No key to encrypt with')
+        token = jwe.JWE(
+            payload, recipient=self._keys[kid], protected=self._headers[kid])
+        return token.serialize(compact=True)
+
+    def decrypt(self, payload):
+        token = jwe.JWE()
+        token.deserialize(payload)
+        key = self._keys.get(token.jose_header.get('kid'))
+        if key is not None:
+            token.decrypt(key)
+            return token.payload
+        # payloads encrypted without kid or with a kid of their own, as
+        # clients encrypting registrations may send, try every key
+        for key in self._keys.values():
+            try:
+                token.decrypt(key)
+                return token.payload
+            except jwe.InvalidJWEData:
+                pass
+        raise jwe.InvalidJWEData('No key can decrypt the payload')
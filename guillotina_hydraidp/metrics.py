@@ -0,0 +1,58 @@
+'''
+Simple in-process metrics, exposed with the `@hydra-metrics` endpoint.
+Values are per worker process.
+'''
+from typing import Any
+from typing import Callable
+from typing import Dict
+
+
+_counters: Dict[str, int] = {}
+_timings: Dict[str, Dict[str, float]] = {}
+_gauges: Dict[str, Callable[[], Any]] = {}
+
+
+def incr(name, value=1):
+    _counters[name] = _counters.get(name, 0) + value
+
+
+def observe(name, value):
+    '''
+    record a timing in seconds
+    '''
+    if name not in _timings:
+        _timings[name] = {
+            'count': 0,
+            'sum': 0.0,
+            'max': 0.0
+        }
+    timing = _timings[name]
+    timing['count'] += 1
+    timing['sum'] += value
+    if value > timing['max']:
+        timing['max'] = value
+
+
+def register_gauge(name, func):
+    '''
+    func is called to get the current value when metrics are collected
+    '''
+    _gauges[name] = func
+
+
+def get_metrics():
+    result = dict(_counters)
+    for name, timing in _timings.items():
+        result[f'{name}.count'] = timing['count']
+        result[f'{name}.sum'] = timing['sum']
+        result[f'{name}.max'] = timing['max']
+        if timing['count']:
+            result[f'{name}.avg'] = timing['sum'] / timing['count']
+    for name, func in _gauges.items():
+        result[name] = func()
+    return result
+
+
+def reset():
+    _counters.clear()
+    _timings.clear()
@@ -0,0 +1,95 @@
+import asyncio
+import logging
+
+import asyncpg
+
+
+logger = logging.getLogger(__name__)
+
+# advisory lock so only one node migrates at a time
+MIGRATION_LOCK_ID = 4857261931
+LOCK_POLL_INTERVAL = 0.5
+VERSION_TABLE = '''CREATE TABLE IF NOT EXISTS hydra_schema_version (
+    version INTEGER NOT NULL PRIMARY KEY,
+    description VARCHAR(255),
+    applied TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now()
+);'''
+
+
+class Migration:
+    '''
+    Statements run in a transaction unless `transaction` is False, which
+    is required for `CREATE INDEX CONCURRENTLY`
+    '''
+
+    def __init__(self, version, description, statements, transaction=True):
+        self.version = version
+        self.description = description
+        self.statements = statements
+        self.transaction = transaction
+
+    async def _run(self, conn):
+        for statement in self.statements:
+            await conn.execute(statement)
+        await conn.execute(
+            'INSERT INTO hydra_schema_version (version, description) '
+            'VALUES ($1, $2)', self.version, self.description)
+
+    async def apply(self, conn):
+        logger.info(f'Applying migration {self.version}: {self.description}')
+        if self.transaction:
+            async with conn.transaction():
+                await self._run(conn)
+        else:
+            await self._run(conn)
+
+
+def create_index_concurrently(name, definition):
+    '''
+    Build an index without locking writes. A failed build leaves an
+    invalid index behind, it is dropped so the migration can run again.
+    '''
+    return [
+        f'DROP INDEX CONCURRENTLY IF EXISTS {name};',
+        f'CREATE INDEX CONCURRENTLY {name} ON {definition};'
+    ]
+
+
+async def get_version(conn):
+    try:
+        return await conn.fetchval(
+            'SELECT max(version) FROM hydra_schema_version')
+    except asyncpg.exceptions.UndefinedTableError:
+        return None
+
+
+async def acquire_migration_lock(conn, interval=LOCK_POLL_INTERVAL):
+    '''
+    Poll instead of blocking in pg_advisory_lock: a waiting statement keeps
+    a snapshot open and `CREATE INDEX CONCURRENTLY` run by the node holding
+    the lock would wait for it forever.
+    '''
+    while not await conn.fetchval(
+            'SELECT pg_try_advisory_lock($1)', MIGRATION_LOCK_ID):
+        await asyncio.sleep(interval)
+
+
+async def migrate(db, migrations, lock_interval=LOCK_POLL_INTERVAL):
+    latest = migrations[-1].version
+    async with db.acquire() as conn:
+        version = await get_version(conn)
+        if version == latest:
+            return version
+
+        await acquire_migration_lock(conn, lock_interval)
+        try:
+            await conn.execute(VERSION_TABLE)
+            # another node may have migrated while we waited on the lock
+            version = await get_version(conn) or 0
+            for migration in migrations:
+                if migration.version > version:
+                    await migration.apply(conn)
+            return latest
+        finally:
+            await conn.execute(
+                'SELECT pg_advisory_unlock($1)', MIGRATION_LOCK_ID)
@@ -0,0 +1,102 @@
+'''
+User counts for dashboards without scanning hydra_users on every call.
+
+The total is the planner estimate from pg_class unless an exact count is
+asked for. Per scope counts are loaded every `hydra.stats.refresh_interval`
+seconds and kept up to date in between from the user events of this
+worker, changes made by other workers show up with the next refresh.
+'''
+import collections
+import time
+
+from guillotina import app_settings, configure
+from guillotina_hydraidp import utils
+from guillotina_hydraidp.concurrency import SingleFlight
+from guillotina_hydraidp.interfaces import IUserCreatedEvent
+from guillotina_hydraidp.interfaces import IUserModifiedEvent
+from guillotina_hydraidp.interfaces import IUserRemovedEvent
+
+
+ESTIMATE_SQL = "SELECT reltuples::bigint FROM pg_class " \
+               "WHERE oid = 'hydra_users'::regclass"
+COUNT_SQL = 'SELECT count(*) FROM hydra_users'
+SCOPE_COUNTS_SQL = 'SELECT scope, count(*) FROM hydra_users, ' \
+                   'jsonb_array_elements_text(allowed_scopes) scope ' \
+                   'GROUP BY scope'
+
+stats_flight = SingleFlight('hydra_stats')
+
+
+class ScopeCounts:
+
+    def __init__(self):
+        self.counts = None
+        self.loaded_at = None
+
+    def is_stale(self, refresh_interval):
+        if self.loaded_at is None:
+            return True
+        return time.monotonic() - self.loaded_at > refresh_interval
+
+    async def load(self):
+        rows = await utils.read_query('fetch', SCOPE_COUNTS_SQL)
+        self.counts = collections.Counter(
+            {row['scope']: row['count'] for row in rows})
+        self.loaded_at = time.monotonic()
+
+    def update(self, scopes, delta):
+        if self.counts is None or not scopes:
+            return
+        for scope in scopes:
+            self.counts[scope] += delta
+            if self.counts[scope] <= 0:
+                del self.counts[scope]
+
+    def age(self):
+        return time.monotonic() - self.loaded_at
+
+
+scope_counts = ScopeCounts()
+
+
+async def count_users(exact=False):
+    '''
+    Returns the number of users and whether it is an estimate
+    '''
+    if not exact:
+        estimate = await utils.read_query('fetchval', ESTIMATE_SQL)
+        # the table was never analyzed yet when there is no estimate
+        if estimate > 0:
+            return estimate, True
+    return await utils.read_query('fetchval', COUNT_SQL), False
+
+
+async def get_user_stats(exact=False):
+    settings = app_settings['hydra'].get('stats') or {}
+    if exact or scope_counts.is_stale(settings.get('refresh_interval', 300)):
+        await stats_flight.do('scopes', scope_counts.load)
+    total, estimated = await count_users(exact)
+    return {
+        'total': total,
+        'estimated': estimated,
+        'scopes': dict(scope_counts.counts),
+        'scopes_age': round(scope_counts.age(), 1)
+    }
+
+
+@configure.subscriber(for_=IUserCreatedEvent)
+async def user_created(event):
+    scope_counts.update(event.allowed_scopes, 1)
+
+
+@configure.subscriber(for_=IUserModifiedEvent)
+async def user_modified(event):
+    if event.previous_scopes is None:
+        return
+    scope_counts.update(event.previous_scopes, -1)
+    scope_counts.update(event.data.get('allowed_scopes'), 1)
+
+
+@configure.subscriber(for_=IUserRemovedEvent)
+async def user_removed(event):
+    scope_counts.update(event.allowed_scopes, -1)
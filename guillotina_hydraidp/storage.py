@@ -1,11 +1,14 @@
 import logging
 
-import asyncpg
 from guillotina import configure
 from guillotina.db.oid import MAX_OID_LENGTH
 from guillotina.db.storages.utils import get_table_definition
 from guillotina.interfaces import IApplicationInitializedEvent
 from guillotina_hydraidp import utils
+from guillotina_hydraidp import warmup
+from guillotina_hydraidp.migrations import Migration
+from guillotina_hydraidp.migrations import create_index_concurrently
+from guillotina_hydraidp.migrations import migrate
 
 logger = logging.getLogger(__name__)
 
@@ -21,12 +24,61 @@ _users_schema = {
 }
 
 
-_initialize_statements = [
-    'CREATE INDEX IF NOT EXISTS user_id ON hydra_users (id);',
-    'CREATE INDEX IF NOT EXISTS user_username ON hydra_users (username);',
-    'CREATE INDEX IF NOT EXISTS user_email ON hydra_users (email);',
-    'CREATE INDEX IF NOT EXISTS user_phone ON hydra_users (phone);',
-    'CREATE INDEX IF NOT EXISTS user_gin_idx ON hydra_users USING gin (allowed_scopes jsonb_path_ops);',  # noqa
+JSONB_MERGE_PATCH_SQL = '''
+CREATE OR REPLACE FUNCTION hydra_jsonb_merge_patch(target jsonb, patch jsonb)
+RETURNS jsonb LANGUAGE plpgsql IMMUTABLE AS $$
+BEGIN
+    IF jsonb_typeof(patch) IS DISTINCT FROM 'object' THEN
+        RETURN patch;
+    END IF;
+    IF jsonb_typeof(target) IS DISTINCT FROM 'object' THEN
+        target := '{}'::jsonb;
+    END IF;
+    RETURN (
+        SELECT COALESCE(jsonb_object_agg(
+            COALESCE(p.key, t.key),
+            CASE WHEN p.key IS NULL THEN t.value
+                 ELSE hydra_jsonb_merge_patch(t.value, p.value) END
+        ), '{}'::jsonb)
+        FROM jsonb_each(target) t
+        FULL OUTER JOIN jsonb_each(patch) p ON t.key = p.key
+        WHERE p.key IS NULL OR jsonb_typeof(p.value) <> 'null');
+END
+$$;'''
+
+
+migrations = [
+    Migration(1, 'create hydra_users', [
+        get_table_definition('hydra_users', _users_schema),
+        'CREATE INDEX IF NOT EXISTS user_phone ON hydra_users (phone);',
+        'CREATE INDEX IF NOT EXISTS user_gin_idx ON hydra_users USING gin (allowed_scopes jsonb_path_ops);',  # noqa
+    ]),
+    # primary key and unique constraints are already indexed
+    Migration(2, 'drop redundant indexes', [
+        'DROP INDEX IF EXISTS user_id;',
+        'DROP INDEX IF EXISTS user_username;',
+        'DROP INDEX IF EXISTS user_email;',
+    ]),
+    Migration(3, 'case insensitive email index', create_index_concurrently(
+        'user_email_lower', 'hydra_users (lower(email))'), transaction=False),
+    Migration(4, 'search indexes', [
+        'CREATE EXTENSION IF NOT EXISTS pg_trgm;'
+    ] + create_index_concurrently(
+        'user_username_trgm', 'hydra_users USING gin (username gin_trgm_ops)'
+    ) + create_index_concurrently(
+        'user_email_trgm', 'hydra_users USING gin (lower(email) gin_trgm_ops)'
+    ) + create_index_concurrently(
+        'user_data_gin_idx', 'hydra_users USING gin (data jsonb_path_ops)'
+    ), transaction=False),
+    # json merge patch (RFC 7396) so partial updates of data are a single
+    # UPDATE without reading the document first
+    Migration(5, 'jsonb merge patch function', [JSONB_MERGE_PATCH_SQL]),
+    # recently active users are loaded by the cache warmup. Not indexed so
+    # login updates stay HOT, warmup reads it once per startup.
+    Migration(6, 'last login', [
+        'ALTER TABLE hydra_users ADD COLUMN IF NOT EXISTS '
+        'last_login TIMESTAMPTZ;'
+    ]),
 ]
 
 
@@ -35,19 +87,5 @@ async def initialize(event):
     db = await utils.get_db(event.loop)
     if db is None:
         return
-
-    statements = [
-        get_table_definition('hydra_users', _users_schema)
-    ]
-    statements.extend(_initialize_statements)
-
-    async with db.acquire() as connection:
-        # Open a transaction.
-        async with connection.transaction():
-            for statement in statements:
-                try:
-                    await connection.execute(statement)
-                except asyncpg.exceptions.UniqueViolationError:
-                    # this is okay on creation
-                    # # means 2 getting created at same time
-                    pass
+    await migrate(db, migrations)
+    warmup.start_warmup(event.app)
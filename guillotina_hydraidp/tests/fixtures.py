@@ -35,4 +35,5 @@ async def guillotina_hydraidp_requester(guillotina, loop):
     import asyncio
     conn = await utils.get_conn(asyncio.get_event_loop())
     await conn.execute('drop table hydra_users;')
+    await conn.execute('drop table hydra_schema_version;')
     await conn.close()
@@ -67,13 +67,15 @@ async def test_join_jwe(guillotina_hydraidp_requester):
     requester = guillotina_hydraidp_requester
 
     from guillotina_hydraidp import utils
+    from guillotina_hydraidp.keyring import Keyring
     from Crypto.PublicKey import RSA
     from guillotina import jose
+    from jwcrypto import jwk
 
     key = RSA.generate(2048)
     pub_jwk = key.publickey().exportKey('PEM')
     priv_jwk = key.exportKey('PEM')
-    utils.REGISTRATION_KEY = {'k': priv_jwk}
+    utils.REGISTRATION_KEYRING = Keyring([jwk.JWK.from_pem(priv_jwk)])
 
     payload = {
         'username': 'foobar',
@@ -89,3 +91,511 @@ async def test_join_jwe(guillotina_hydraidp_requester):
 
     resp, status = await requester('GET', '/@users')
     assert len(resp) == 1
+
+
+async def test_paginate_users(guillotina_hydraidp_requester):
+    requester = guillotina_hydraidp_requester
+    for idx in range(3):
+        resp, status = await requester('POST', '/@users', data=json.dumps({
+            'id': f'foobar{idx}',
+            'username': f'foobar{idx}',
+            'password': 'foobar'
+        }))
+        assert status == 200
+
+    resp, status = await requester('GET', '/@users?limit=2')
+    assert [item['id'] for item in resp] == ['foobar0', 'foobar1']
+
+    resp, status = await requester(
+        'GET', '/@users?limit=2&cursor=foobar1')
+    assert [item['id'] for item in resp] == ['foobar2']
+
+    for limit in ('0', '-1', 'foobar'):
+        resp, status = await requester('GET', f'/@users?limit={limit}')
+        assert status == 400
+
+
+async def test_bulk_import_users(guillotina_hydraidp_requester):
+    requester = guillotina_hydraidp_requester
+    resp, status = await requester('POST', '/@users', data=json.dumps({
+        'id': 'foobar',
+        'username': 'foobar',
+        'password': 'foobar'
+    }))
+    assert status == 200
+
+    lines = [
+        json.dumps({'username': 'foobar', 'password': 'foobar'}),
+        json.dumps({'username': 'foobar2', 'password': 'foobar',
+                    'email': 'foobar2@foobar.com'}),
+        json.dumps({'username': 'foobar3'}),
+        # users without email do not conflict with each other
+        json.dumps({'username': 'foobar4', 'password': 'foobar'}),
+        json.dumps({'username': 'foobar5', 'password': 'foobar'}),
+    ]
+    resp, status = await requester(
+        'POST', '/@users/@bulk', data='\n'.join(lines))
+    assert status == 200
+    assert resp['created'] == 3
+    assert [error['line'] for error in resp['errors']] == [1, 3]
+
+    resp, status = await requester('GET', '/@users')
+    assert len(resp) == 4
+
+
+async def test_search_users(guillotina_hydraidp_requester):
+    requester = guillotina_hydraidp_requester
+    for idx, scopes in enumerate([['cms:role:guillotina.Member'], []]):
+        resp, status = await requester('POST', '/@users', data=json.dumps({
+            'id': f'foobar{idx}',
+            'username': f'foobar{idx}',
+            'email': f'foobar{idx}@FOOBAR.com',
+            'password': 'foobar',
+            'allowed_scopes': scopes,
+            'data': {'idx': idx}
+        }))
+        assert status == 200
+
+    resp, status = await requester(
+        'GET', '/@users/@search?scope=cms:role:guillotina.Member')
+    assert [item['id'] for item in resp] == ['foobar0']
+
+    resp, status = await requester(
+        'GET', '/@users/@search?data={"idx": 1}')
+    assert [item['id'] for item in resp] == ['foobar1']
+
+    resp, status = await requester('GET', '/@users/@search?username=foo')
+    assert len(resp) == 2
+    assert 'password' not in resp[0]
+
+    resp, status = await requester(
+        'GET', '/@users/@search?email=1@foobar&match=contains')
+    assert [item['id'] for item in resp] == ['foobar1']
+
+
+async def test_merge_patch_user(guillotina_hydraidp_requester):
+    requester = guillotina_hydraidp_requester
+    resp, status = await requester('POST', '/@users', data=json.dumps({
+        'id': 'foobar',
+        'username': 'foobar',
+        'password': 'foobar',
+        'allowed_scopes': ['foo', 'bar'],
+        'data': {'name': 'Foo', 'address': {'city': 'Foo', 'zip': '1'}}
+    }))
+    assert status == 200
+
+    resp, status = await requester('PATCH', '/@users/foobar', data=json.dumps({
+        'phone': '123',
+        'data': {'name': None, 'address': {'zip': '2'}},
+        'add_scopes': ['foo', 'baz'],
+        'remove_scopes': ['bar']
+    }), headers={'Content-Type': 'application/merge-patch+json'})
+    assert status == 200
+    assert resp['phone'] == '123'
+    assert resp['data'] == {'address': {'city': 'Foo', 'zip': '2'}}
+    assert sorted(resp['allowed_scopes']) == ['baz', 'foo']
+    assert 'password' not in resp
+
+    # only the server decides how the body is applied
+    resp, status = await requester('PATCH', '/@users/foobar', data=json.dumps({
+        'id': 'other',
+        'userid': 'other',
+        'merge': False,
+        'data': {'address': {'zip': '3'}}
+    }), headers={'Content-Type': 'application/merge-patch+json'})
+    assert status == 200
+    assert resp['id'] == 'foobar'
+    assert resp['data'] == {'address': {'city': 'Foo', 'zip': '3'}}
+
+    resp, status = await requester('PATCH', '/@users/missing', data=json.dumps({
+        'data': {'name': 'Foo'}
+    }), headers={'Content-Type': 'application/merge-patch+json'})
+    assert status == 404
+
+
+async def test_update_user_returns_stored_row(guillotina_hydraidp_requester):
+    requester = guillotina_hydraidp_requester
+    resp, status = await requester('POST', '/@users', data=json.dumps({
+        'id': 'foobar',
+        'username': 'foobar',
+        'password': 'foobar'
+    }))
+    assert status == 200
+
+    resp, status = await requester('PATCH', '/@users/foobar', data=json.dumps({
+        'email': 'Foobar@Foobar.com',
+        'password': 'foobar2'
+    }))
+    assert status == 200
+    assert resp['email'] == 'foobar@foobar.com'
+    assert resp['username'] == 'foobar'
+    assert 'password' not in resp
+
+    # a plain PATCH only replaces columns
+    resp, status = await requester('PATCH', '/@users/foobar', data=json.dumps({
+        'merge': True,
+        'add_scopes': ['foo'],
+        'allowed_scopes': ['bar']
+    }))
+    assert status == 200
+    assert resp['allowed_scopes'] == ['bar']
+
+    resp, status = await requester('PATCH', '/@users/missing', data=json.dumps({
+        'email': 'missing@foobar.com'
+    }))
+    assert status == 404
+
+    resp, status = await requester('DELETE', '/@users/missing')
+    assert status == 404
+
+
+async def test_batch_get_users(guillotina_hydraidp_requester):
+    requester = guillotina_hydraidp_requester
+    for idx in range(3):
+        resp, status = await requester('POST', '/@users', data=json.dumps({
+            'id': f'foobar{idx}',
+            'username': f'foobar{idx}',
+            'password': 'foobar'
+        }))
+        assert status == 200
+
+    resp, status = await requester(
+        'POST', '/@users/@batch-get', data=json.dumps({
+            'ids': ['foobar2', 'missing', 'foobar0']
+        }))
+    assert status == 200
+    assert [item['id'] for item in resp['items']] == ['foobar2', 'foobar0']
+    assert resp['missing'] == ['missing']
+    assert 'password' not in resp['items'][0]
+
+    resp, status = await requester(
+        'POST', '/@users/@batch-get', data=json.dumps({
+            'ids': [f'foobar{idx}' for idx in range(101)]
+        }))
+    assert status == 412
+
+
+async def test_user_stats(guillotina_hydraidp_requester):
+    requester = guillotina_hydraidp_requester
+    for idx, scopes in enumerate([['foo', 'bar'], ['foo']]):
+        resp, status = await requester('POST', '/@users', data=json.dumps({
+            'id': f'foobar{idx}',
+            'username': f'foobar{idx}',
+            'password': 'foobar',
+            'allowed_scopes': scopes
+        }))
+        assert status == 200
+
+    resp, status = await requester('GET', '/@users/@stats?exact=true')
+    assert status == 200
+    assert resp['total'] == 2
+    assert not resp['estimated']
+    assert resp['scopes'] == {'foo': 2, 'bar': 1}
+
+    resp, status = await requester('PATCH', '/@users/foobar1', data=json.dumps({
+        'add_scopes': ['bar'],
+        'remove_scopes': ['foo']
+    }), headers={'Content-Type': 'application/merge-patch+json'})
+    assert status == 200
+    resp, status = await requester('DELETE', '/@users/foobar0')
+    assert status == 200
+
+    resp, status = await requester('GET', '/@users/@stats')
+    assert resp['scopes'] == {'bar': 1}
+
+
+async def test_user_changes_invalidate_identifier_cache(
+        guillotina_hydraidp_requester):
+    from guillotina_hydraidp.identifier import get_user_cache_key
+    from guillotina_rediscache import cache
+
+    requester = guillotina_hydraidp_requester
+    resp, status = await requester('POST', '/@users', data=json.dumps({
+        'id': 'foobar',
+        'username': 'foobar',
+        'password': 'foobar'
+    }))
+    assert status == 200
+
+    store = cache.get_memory_cache()
+    store[get_user_cache_key('foobar')] = 'cached'
+    resp, status = await requester('PATCH', '/@users/foobar', data=json.dumps({
+        'allowed_scopes': ['cms:role:guillotina.Member']
+    }))
+    assert status == 200
+    assert get_user_cache_key('foobar') not in store
+
+    store[get_user_cache_key('foobar')] = 'cached'
+    resp, status = await requester('DELETE', '/@users/foobar')
+    assert status == 200
+    assert get_user_cache_key('foobar') not in store
+
+
+async def test_identifier_coalesces_and_caches_unknown_users(
+        guillotina_hydraidp_requester):
+    import asyncio
+    from guillotina_hydraidp import metrics
+    from guillotina_hydraidp.identifier import HydraDBUserIdentifier
+
+    requester = guillotina_hydraidp_requester
+    resp, status = await requester('POST', '/@users', data=json.dumps({
+        'id': 'foobar',
+        'username': 'foobar',
+        'password': 'foobar'
+    }))
+    assert status == 200
+
+    metrics.reset()
+    identifier = HydraDBUserIdentifier(object())
+    users = await asyncio.gather(*[
+        identifier.get_user({'id': 'foobar'}) for _ in range(5)])
+    assert all(user.id == 'foobar' for user in users)
+    assert metrics.get_metrics()['user_cache.coalesced'] == 4
+
+    assert await identifier.get_user({'id': 'missing'}) is None
+    assert await identifier.get_user({'id': 'missing'}) is None
+    assert metrics.get_metrics()['user_cache.negatives'] == 1
+
+
+async def test_find_user_cache_follows_updates(guillotina_hydraidp_requester):
+    requester = guillotina_hydraidp_requester
+    resp, status = await requester('POST', '/@users', data=json.dumps({
+        'id': 'foobar',
+        'username': 'foobar',
+        'password': 'foobar',
+        'data': {'name': 'Foo'}
+    }))
+    assert status == 200
+
+    resp, status = await requester('GET', '/@users/foobar')
+    assert resp['data'] == {'name': 'Foo'}
+    resp, status = await requester('PATCH', '/@users/foobar', data=json.dumps({
+        'data': {'name': 'Bar'}
+    }))
+    assert status == 200
+    resp, status = await requester('GET', '/@users/foobar')
+    assert resp['data'] == {'name': 'Bar'}
+
+    resp, status = await requester('DELETE', '/@users/foobar')
+    resp, status = await requester('GET', '/@users/foobar')
+    assert status == 404
+
+
+async def test_identifier_misses_skip_find_user_cache(
+        guillotina_hydraidp_requester):
+    from guillotina_hydraidp import utils
+    from guillotina_hydraidp.identifier import HydraDBUserIdentifier
+    from guillotina_hydraidp.identifier import get_user_cache_key
+    from guillotina_rediscache import cache
+
+    requester = guillotina_hydraidp_requester
+    resp, status = await requester('POST', '/@users', data=json.dumps({
+        'id': 'foobar',
+        'username': 'foobar',
+        'password': 'foobar'
+    }))
+    assert status == 200
+    assert (await utils.find_user(username='foobar'))['allowed_scopes'] == []
+
+    # changed by another node, this worker is not told
+    db = await utils.get_db()
+    async with db.acquire() as conn:
+        await conn.execute(
+            "UPDATE hydra_users SET allowed_scopes = "
+            "'[\"cms:role:guillotina.Member\"]'::jsonb WHERE id = 'foobar'")
+    assert (await utils.find_user(username='foobar'))['allowed_scopes'] == []
+
+    identifier = HydraDBUserIdentifier(object())
+    assert (await identifier.get_user({'id': 'foobar'})).id == 'foobar'
+    cached = cache.get_memory_cache()[get_user_cache_key('foobar')]
+    assert cached.scopes == ('cms:role:guillotina.Member',)
+    user = await utils.find_user(username='foobar')
+    assert user['allowed_scopes'] == ['cms:role:guillotina.Member']
+
+
+async def test_warmup_user_cache(guillotina_hydraidp_requester):
+    from guillotina import app_settings
+    from guillotina_hydraidp import utils
+    from guillotina_hydraidp import warmup
+    from guillotina_hydraidp.identifier import get_user_cache_key
+    from guillotina_rediscache import cache
+
+    requester = guillotina_hydraidp_requester
+    for idx in range(3):
+        resp, status = await requester('POST', '/@users', data=json.dumps({
+            'id': f'warmup{idx}',
+            'username': f'warmup{idx}',
+            'password': 'foobar',
+            'allowed_scopes': ['cms:role:guillotina.Member']
+        }))
+        assert status == 200
+    settings = app_settings['hydra']
+    warmup_settings = settings.get('warmup')
+    await utils.record_login('warmup0')
+    assert await warmup.get_warmup_logins(10) == []
+    settings['warmup'] = {'enabled': True}
+    try:
+        await utils.record_login('warmup0')
+        await utils.record_login('warmup2')
+    finally:
+        settings['warmup'] = warmup_settings
+
+    store = cache.get_memory_cache()
+    assert await warmup.warmup_user_cache(size=10, batch_size=1) == 2
+    cached = store[get_user_cache_key('warmup2')]
+    assert cached.get_user('cms')._roles == {'guillotina.Member': 1}
+    assert get_user_cache_key('warmup1') not in store
+    assert 'warmup0' in warmup.get_cached_logins()
+
+
+async def test_migrate_waits_for_lock(guillotina_hydraidp_requester):
+    import asyncio
+    from guillotina_hydraidp import storage
+    from guillotina_hydraidp import utils
+    from guillotina_hydraidp.migrations import MIGRATION_LOCK_ID
+    from guillotina_hydraidp.migrations import Migration
+    from guillotina_hydraidp.migrations import get_version
+    from guillotina_hydraidp.migrations import migrate
+
+    db = await utils.get_db()
+    latest = storage.migrations[-1].version
+    async with db.acquire() as conn:
+        assert await get_version(conn) == latest
+    assert await migrate(db, storage.migrations) == latest
+
+    migrations = storage.migrations + [
+        Migration(latest + 1, 'noop', ['SELECT 1;'])]
+    async with db.acquire() as holder:
+        await holder.execute('SELECT pg_advisory_lock($1)', MIGRATION_LOCK_ID)
+        task = asyncio.ensure_future(
+            migrate(db, migrations, lock_interval=0.05))
+        await asyncio.sleep(0.2)
+        assert not task.done()
+        await holder.execute(
+            'SELECT pg_advisory_unlock($1)', MIGRATION_LOCK_ID)
+        assert await task == latest + 1
+
+    async with db.acquire() as conn:
+        assert await get_version(conn) == latest + 1
+        assert await conn.fetchval(
+            'SELECT count(*) FROM hydra_schema_version') == latest + 1
+
+
+async def test_replica_reads_fall_back_to_primary(
+        guillotina_hydraidp_requester):
+    from guillotina.component import get_utility
+    from guillotina.interfaces import IApplication
+    from guillotina_hydraidp import metrics
+    from guillotina_hydraidp import utils
+
+    class BrokenPool:
+        async def acquire(self, timeout=None):
+            raise ConnectionRefusedError()
+
+    requester = guillotina_hydraidp_requester
+    resp, status = await requester('POST', '/@users', data=json.dumps({
+        'id': 'foobar',
+        'username': 'foobar',
+        'password': 'foobar'
+    }))
+    assert status == 200
+
+    root = get_utility(IApplication, name='root')
+    primary = await utils.get_db()
+    # the primary is not in recovery, it has no lag
+    replica = utils.Replica('replica', primary)
+    broken = utils.Replica('broken', BrokenPool())
+    setattr(root, utils.REPLICAS_ATTR, [replica])
+    try:
+        metrics.reset()
+        users, missing = await utils.find_users_by_ids(['foobar'])
+        assert [user['id'] for user in users] == ['foobar']
+        assert metrics.get_metrics()['db.reads.replica'] == 1
+
+        await utils.check_replicas([replica, broken], max_lag=0)
+        assert replica.healthy
+        assert not broken.healthy
+
+        broken.healthy = True
+        setattr(root, utils.REPLICAS_ATTR, [broken])
+        metrics.reset()
+        users, missing = await utils.find_users_by_ids(['foobar', 'missing'])
+        assert [user['id'] for user in users] == ['foobar']
+        assert missing == ['missing']
+        assert not broken.healthy
+        assert metrics.get_metrics()['db.replica_failures'] == 1
+        assert await utils.get_db(readonly=True) is primary
+    finally:
+        setattr(root, utils.REPLICAS_ATTR, [])
+
+
+async def test_identifier_basic_auth_user_has_password(
+        guillotina_hydraidp_requester):
+    from guillotina_hydraidp import utils
+    from guillotina_hydraidp.identifier import HydraDBUserIdentifier
+    from guillotina_hydraidp.identifier import get_user_cache_key
+    from guillotina_rediscache import cache
+
+    requester = guillotina_hydraidp_requester
+    resp, status = await requester('POST', '/@users', data=json.dumps({
+        'id': 'foobar',
+        'username': 'foobar',
+        'password': 'foobar'
+    }))
+    assert status == 200
+
+    identifier = HydraDBUserIdentifier(object())
+    user = await identifier.get_user({'id': 'foobar'})
+    assert getattr(user, 'password', None) is None
+
+    user = await identifier.get_user({
+        'type': 'basic', 'id': 'foobar', 'token': 'foobar'})
+    assert utils.check_argon2_password(user.password, 'foobar')
+    assert not hasattr(
+        cache.get_memory_cache()[get_user_cache_key('foobar')], 'password')
+
+
+async def test_export_users(guillotina_hydraidp_requester):
+    from guillotina.security.security_code import role_permission_manager
+
+    requester = guillotina_hydraidp_requester
+    resp, status = await requester('POST', '/@users', data=json.dumps({
+        'id': 'foobar',
+        'username': 'foobar',
+        'password': 'foobar',
+        'data': {'name': 'Foo'}
+    }))
+    assert status == 200
+
+    resp, status = await requester('GET', '/@users/@export')
+    assert status == 200
+    users = [json.loads(line) for line in resp.decode('utf-8').splitlines()]
+    assert len(users) == 1
+    assert users[0]['id'] == 'foobar'
+    assert users[0]['data'] == {'name': 'Foo'}
+    assert 'password' not in users[0]
+
+    resp, status = await requester('GET', '/@users/@export?format=csv')
+    assert status == 200
+    lines = resp.decode('utf-8').splitlines()
+    assert lines[0] == 'id,username,email,phone,data,allowed_scopes'
+    assert lines[1].startswith('foobar,foobar,')
+
+    resp, status = await requester(
+        'GET', '/@users/@export?format=csv&include_password=true')
+    assert 'password' in resp.decode('utf-8').splitlines()[0].split(',')
+
+    resp, status = await requester('GET', '/@users/@export?format=xml')
+    assert status == 400
+
+    # reaching the action is not enough, the export permission is checked
+    role_permission_manager.grant_permission_to_role(
+        'guillotina.GetUser', 'guillotina.Anonymous')
+    try:
+        resp, status = await requester(
+            'GET', '/@users/@export', authenticated=False)
+        assert status == 401
+        assert resp['reason'] == 'Not allowed to call @export'
+    finally:
+        role_permission_manager.unset_permission_from_role(
+            'guillotina.GetUser', 'guillotina.Anonymous')
@@ -0,0 +1,169 @@
+import pytest
+
+from guillotina_hydraidp import utils
+
+
+def test_password_needs_rehash():
+    params = (('time_cost', 2),)
+    token = utils.hash_argon2_password('foobar', params=params)
+    assert utils.check_argon2_password(token, 'foobar')
+    assert not utils.check_argon2_password(token, 'foobar2')
+    assert not utils.password_needs_rehash(token, params=params)
+    assert utils.password_needs_rehash(
+        token, params=(('time_cost', 3),))
+    assert utils.password_needs_rehash('sha512:salt:foobar', params=params)
+
+
+async def test_admission_limiter_sheds_load():
+    from guillotina.response import HTTPTooManyRequests
+    from guillotina_hydraidp import metrics
+    from guillotina_hydraidp.concurrency import AdmissionLimiter
+
+    limiter = AdmissionLimiter('test', max_active=1, queue_size=0, max_wait=1)
+    async with limiter:
+        try:
+            async with limiter:
+                pass
+            assert False
+        except HTTPTooManyRequests as resp:
+            assert resp.headers['Retry-After'] == '1'
+    assert metrics.get_metrics()['test.rejected'] == 1
+    async with limiter:
+        assert limiter.active == 1
+
+
+def test_circuit_breaker_opens_on_error_rate():
+    from guillotina_hydraidp.concurrency import CircuitBreaker
+
+    breaker = CircuitBreaker('test', error_threshold=0.5, min_requests=4,
+                             reset_timeout=0)
+    breaker.record_success()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == breaker.CLOSED
+    breaker.record_failure()
+    assert breaker.state == breaker.OPEN
+
+    # after reset timeout, only one trial call is allowed
+    assert breaker.allow()
+    assert breaker.state == breaker.HALF_OPEN
+    assert not breaker.allow()
+    breaker.record_success()
+    assert breaker.state == breaker.CLOSED
+    assert breaker.allow()
+
+
+async def test_single_flight_shares_call():
+    import asyncio
+    from guillotina_hydraidp.concurrency import SingleFlight
+
+    calls = []
+
+    async def lookup(value):
+        calls.append(value)
+        await asyncio.sleep(0.01)
+        return value
+
+    flight = SingleFlight('test')
+    results = await asyncio.gather(*[
+        flight.do('key', lookup, 'foobar') for _ in range(5)])
+    assert results == ['foobar'] * 5
+    assert len(calls) == 1
+
+
+def test_lru_cache():
+    from guillotina_hydraidp.caching import LRUCache, MISSING
+
+    cache = LRUCache('test_lru', max_size=2, ttl=60)
+    cache.set('foo', 1)
+    cache.set('bar', 2)
+    assert cache.get('foo') == 1
+    cache.set('baz', 3)
+    # bar was least recently used
+    assert cache.get('bar') is MISSING
+    cache.set('foo', 1, ttl=-1)
+    assert cache.get('foo') is MISSING
+    assert len(cache) == 1
+
+
+def test_find_user_cache_lookups():
+    from guillotina_hydraidp import utils
+    from guillotina_hydraidp.caching import LRUCache
+
+    cache = LRUCache('test_find_user', ttl=60)
+    user = {'id': 'foo', 'username': 'foobar', 'email': 'foo@foobar.com'}
+    utils._cache_user(cache, user)
+    assert utils._get_cached_user(cache, 'id', 'foo') is user
+    assert utils._get_cached_user(cache, 'username', 'foobar') is user
+    assert utils._get_cached_user(cache, 'email', 'foo@foobar.com') is user
+
+    # the old username still points to the id but does not match anymore
+    utils._cache_user(cache, dict(user, username='renamed'))
+    assert utils._get_cached_user(cache, 'username', 'foobar') is None
+    assert utils._get_cached_user(cache, 'username', 'renamed') is not None
+
+
+def test_cached_user_roles_per_container():
+    from guillotina_hydraidp.identifier import CachedUser
+
+    cached = CachedUser.from_user_data({
+        'username': 'foobar',
+        'allowed_scopes': [
+            'cms:role:guillotina.Member',
+            'cms:permission:guillotina.AccessContent',
+            'other:role:guillotina.Reader',
+            'invalid'
+        ]
+    })
+    with pytest.raises(AttributeError):
+        cached.id = 'other'
+
+    user = cached.get_user('cms')
+    assert user.id == 'foobar'
+    assert user._roles == {'guillotina.Member': 1}
+    assert user._permissions == {'guillotina.AccessContent': 1}
+    assert cached.get_user('other')._roles == {'guillotina.Reader': 1}
+    assert cached.get_user(None)._roles == {}
+
+
+def test_cached_user_global_scopes():
+    from guillotina_hydraidp.identifier import CachedUser
+
+    cached = CachedUser.from_user_data({
+        'username': 'foobar',
+        'allowed_scopes': [
+            'role:guillotina.Member',
+            'permission:guillotina.AccessContent',
+            'cms:role:guillotina.Reader',
+            'other:guillotina.Member'
+        ]
+    })
+    user = cached.get_user('cms')
+    assert user._roles == {'guillotina.Member': 1, 'guillotina.Reader': 1}
+    assert user._permissions == {'guillotina.AccessContent': 1}
+    assert cached.get_user('other')._roles == {'guillotina.Member': 1}
+    user = cached.get_user(None)
+    assert user._roles == {'guillotina.Member': 1}
+    assert user._permissions == {'guillotina.AccessContent': 1}
+
+
+def test_keyring_rotation():
+    from guillotina_hydraidp.keyring import Keyring
+    from jwcrypto import jwe, jwk
+
+    old_key = jwk.JWK.generate(kty='RSA', size=2048)
+    new_key = jwk.JWK.generate(kty='RSA', size=2048)
+    old_payload = Keyring([old_key]).encrypt(b'old')
+
+    keyring = Keyring([new_key, old_key])
+    assert keyring.current_kid == new_key.thumbprint()
+    assert keyring.decrypt(old_payload) == b'old'
+    assert keyring.decrypt(keyring.encrypt(b'new')) == b'new'
+
+    other_kid = Keyring()
+    other_kid.add(old_key, 'client-key')
+    assert keyring.decrypt(other_kid.encrypt(b'other')) == b'other'
+
+    keyring.remove(old_key.thumbprint())
+    with pytest.raises(jwe.InvalidJWEData):
+        keyring.decrypt(old_payload)
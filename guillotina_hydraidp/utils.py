@@ -1,52 +1,428 @@
+import asyncio
+import itertools
 import json
 import logging
+import os
+import time
 import uuid
 import datetime
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+from typing import Dict
 
 import aiohttp
 import argon2
 import asyncpg
+import jsonschema
 from guillotina import app_settings, configure
-from guillotina.auth.validators import hash_password
+from guillotina.auth.validators import check_password
 from guillotina.component import get_utility
-from guillotina.interfaces import (IApplication, IPasswordChecker,
-                                   IPasswordHasher)
+from guillotina.exceptions import RequestNotFound
+from guillotina.interfaces import (IApplication, IApplicationCleanupEvent,
+                                   IApplicationInitializedEvent,
+                                   IPasswordChecker, IPasswordHasher)
+from guillotina.response import HTTPServiceUnavailable
+from guillotina.utils import get_current_request
+from pypika import Parameter
+from pypika import functions as fn
 from pypika import PostgreSQLQuery as Query
 from pypika import Table
-from jwcrypto import jwe, jwk
+from jwcrypto import jwe
 from guillotina.event import notify
+from guillotina_hydraidp import metrics
+from guillotina_hydraidp.caching import LRUCache
+from guillotina_hydraidp.concurrency import AdmissionLimiter
+from guillotina_hydraidp.keyring import Keyring
 from guillotina_hydraidp.events import UserCreatedEvent
 from guillotina_hydraidp.events import UserModifiedEvent
 from guillotina_hydraidp.events import UserRemovedEvent
 
+try:
+    import orjson
+except ImportError:
+    orjson = None  # type: ignore
+
 
 logger = logging.getLogger(__name__)
 
 users_table = Table('hydra_users')
-ph = argon2.PasswordHasher()
+MAX_PAGE_SIZE = 1000
+USER_COLUMNS = (
+    'id', 'username', 'password', 'email', 'phone', 'data', 'allowed_scopes')
+ARGON2_PARAMS = (
+    'time_cost', 'memory_cost', 'parallelism', 'hash_len', 'salt_len')
+_password_hashers: Dict[Any, argon2.PasswordHasher] = {}
 
 DB_ATTR = '_hydraidp_db_pool'
-REGISTRATION_KEY = None
-PUB_INTERNAL_KEY = None
-PRIV_INTERNAL_KEY = None
+DB_INIT_ATTR = '_hydraidp_db_pool_init'
+REPLICAS_ATTR = '_hydraidp_db_replicas'
+REPLICAS_TASK_ATTR = '_hydraidp_db_replicas_task'
+HTTP_ATTR = '_hydraidp_http_session'
+REGISTRATION_KEYRING = None
+INTERNAL_KEYRING = None
+PASSWORD_EXECUTOR = None
+PASSWORD_LIMITER = None
+FIND_USER_CACHE = None
+# bumped on every change so lookups that started before it do not cache
+# what they read
+_find_user_generation = 0
+_replica_counter = itertools.count()
+
+
+def get_argon2_params():
+    '''
+    Hashable representation of the `hydra.argon2` setting. Unset values
+    fall back to the argon2_cffi defaults.
+    '''
+    settings = app_settings['hydra'].get('argon2') or {}
+    return tuple(sorted(
+        (key, value) for key, value in settings.items()
+        if key in ARGON2_PARAMS and value is not None))
+
+
+def get_password_hasher(params=None):
+    if params is None:
+        params = get_argon2_params()
+    if params not in _password_hashers:
+        _password_hashers[params] = argon2.PasswordHasher(**dict(params))
+    return _password_hashers[params]
 
 
 @configure.utility(provides=IPasswordHasher, name='argon2')
 def argon_pw_hasher(pw, salt):
-    return ph.hash(pw + salt)
+    return get_password_hasher().hash(pw + salt)
 
 
 @configure.utility(provides=IPasswordChecker, name='argon2')
 def argon_pw_checker(token, pw):
     split = token.split(':')
     try:
-        return ph.verify(split[-1], pw + split[-2])
+        # parameters are encoded in the hash so any hasher can verify
+        return get_password_hasher(()).verify(split[-1], pw + split[-2])
     except (argon2.exceptions.InvalidHash,
             argon2.exceptions.VerifyMismatchError):
         return False
 
 
-async def get_db(loop=None):
+def hash_argon2_password(pw, salt=None, params=None):
+    '''
+    Same output as `guillotina.auth.validators.hash_password` with the
+    argon2 algorithm but without a utility lookup so it can run in
+    a worker process.
+    '''
+    if salt is None:
+        salt = uuid.uuid4().hex
+    hashed = get_password_hasher(params).hash(
+        pw.encode('utf-8') + salt.encode('utf-8'))
+    return 'argon2:{}:{}'.format(salt, hashed)
+
+
+def password_needs_rehash(token, params=None):
+    '''
+    Stored passwords that are not argon2 or were hashed with other
+    parameters than the configured ones need to be rehashed
+    '''
+    split = token.split(':')
+    if len(split) != 3 or split[0] != 'argon2':
+        return True
+    try:
+        return get_password_hasher(params).check_needs_rehash(split[-1])
+    except argon2.exceptions.InvalidHash:
+        return True
+
+
+def check_argon2_password(token, pw):
+    if not token.startswith('argon2:'):
+        return check_password(token, pw)
+    return argon_pw_checker(token, pw)
+
+
+def get_password_executor():
+    '''
+    Executor argon2 hashing and verification are run in.
+    `None` means work is done inline on the event loop.
+    '''
+    global PASSWORD_EXECUTOR
+    mode = app_settings['hydra'].get('password_executor', 'thread')
+    if mode == 'inline':
+        return None
+    if PASSWORD_EXECUTOR is None:
+        size = app_settings['hydra'].get('password_executor_size')
+        if mode == 'process':
+            PASSWORD_EXECUTOR = ProcessPoolExecutor(max_workers=size)
+        elif mode == 'thread':
+            PASSWORD_EXECUTOR = ThreadPoolExecutor(max_workers=size)
+        else:
+            raise Exception(f'Invalid password_executor setting: {mode}')
+    return PASSWORD_EXECUTOR
+
+
+def get_password_limiter():
+    global PASSWORD_LIMITER
+    loop = asyncio.get_event_loop()
+    if PASSWORD_LIMITER is None or PASSWORD_LIMITER.loop is not loop:
+        settings = app_settings['hydra'].get('password_admission') or {}
+        PASSWORD_LIMITER = AdmissionLimiter(
+            'password',
+            max_active=settings.get('max_active') or os.cpu_count() or 1,
+            queue_size=settings.get('queue_size', 100),
+            max_wait=settings.get('max_wait', 5),
+            retry_after=settings.get('retry_after', 1),
+            loop=loop)
+    return PASSWORD_LIMITER
+
+
+async def run_password_task(func, *args):
+    async with get_password_limiter():
+        executor = get_password_executor()
+        if executor is None:
+            return func(*args)
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(executor, func, *args)
+
+
+async def hash_user_password(pw):
+    # resolve parameters here, worker processes may not have settings
+    return await run_password_task(
+        hash_argon2_password, pw, None, get_argon2_params())
+
+
+def hash_argon2_passwords(passwords, params=None):
+    return [hash_argon2_password(pw, params=params) for pw in passwords]
+
+
+async def hash_user_passwords(passwords, chunk_size=50):
+    '''
+    Hash many passwords for bulk operations. Passwords are sent to the
+    executor in chunks to limit scheduling overhead and do not go through
+    the admission limiter. At most `hydra.bulk_hash_concurrency` chunks
+    are in the executor at a time so logins still get workers.
+    '''
+    params = get_argon2_params()
+    chunks = [passwords[idx:idx + chunk_size]
+              for idx in range(0, len(passwords), chunk_size)]
+    executor = get_password_executor()
+    if executor is None:
+        results = [hash_argon2_passwords(chunk, params) for chunk in chunks]
+    else:
+        loop = asyncio.get_event_loop()
+        concurrency = app_settings['hydra'].get('bulk_hash_concurrency')
+        semaphore = asyncio.Semaphore(
+            concurrency or max(1, (os.cpu_count() or 1) // 2))
+
+        async def _hash_chunk(chunk):
+            async with semaphore:
+                return await loop.run_in_executor(
+                    executor, hash_argon2_passwords, chunk, params)
+
+        results = await asyncio.gather(*[
+            _hash_chunk(chunk) for chunk in chunks])
+    return [hashed for chunk in results for hashed in chunk]
+
+
+async def check_user_password(token, pw):
+    return await run_password_task(check_argon2_password, token, pw)
+
+
+@configure.subscriber(for_=IApplicationCleanupEvent)
+async def close_password_executor(event):
+    global PASSWORD_EXECUTOR
+    if PASSWORD_EXECUTOR is not None:
+        PASSWORD_EXECUTOR.shutdown(wait=False)
+        PASSWORD_EXECUTOR = None
+
+
+def get_http_timeout():
+    settings = app_settings['hydra'].get('http') or {}
+    return aiohttp.ClientTimeout(
+        total=settings.get('timeout', 30),
+        connect=settings.get('connect_timeout', 5))
+
+
+def get_http_session():
+    '''
+    Application scoped session so connections to hydra and other
+    services are kept alive between requests. It does not store cookies
+    since it is shared by all users, see `get_flow_session`.
+    '''
+    root = get_utility(IApplication, name='root')
+    session = getattr(root, HTTP_ATTR, None)
+    if session is None or session.closed:
+        settings = app_settings['hydra'].get('http') or {}
+        connector = aiohttp.TCPConnector(
+            limit=settings.get('limit', 100),
+            limit_per_host=settings.get('limit_per_host', 0),
+            ttl_dns_cache=settings.get('dns_cache_ttl', 10),
+            keepalive_timeout=settings.get('keepalive_timeout', 15))
+        session = aiohttp.ClientSession(
+            connector=connector,
+            cookie_jar=aiohttp.DummyCookieJar(),
+            timeout=get_http_timeout())
+        setattr(root, HTTP_ATTR, session)
+    return session
+
+
+def get_flow_session():
+    '''
+    Session with its own cookie jar for multi step oauth flows that
+    reuses the pooled connections of the application session
+    '''
+    return aiohttp.ClientSession(
+        connector=get_http_session().connector,
+        connector_owner=False,
+        timeout=get_http_timeout())
+
+
+@configure.subscriber(for_=IApplicationInitializedEvent)
+async def initialize_http_session(event):
+    get_http_session()
+
+
+@configure.subscriber(for_=IApplicationCleanupEvent)
+async def close_http_session(event):
+    root = get_utility(IApplication, name='root')
+    session = getattr(root, HTTP_ATTR, None)
+    if session is not None:
+        await session.close()
+        delattr(root, HTTP_ATTR)
+
+
+metrics.register_gauge(
+    'password.active',
+    lambda: PASSWORD_LIMITER.active if PASSWORD_LIMITER else 0)
+metrics.register_gauge(
+    'password.waiting',
+    lambda: PASSWORD_LIMITER.waiting if PASSWORD_LIMITER else 0)
+
+
+def get_json_serializer():
+    '''
+    (dumps, loads) working with bytes, orjson is used when installed
+    unless `hydra.db.json_serializer` is set to `json`
+    '''
+    db_config = app_settings['hydra'].get('db') or {}
+    name = db_config.get('json_serializer')
+    if name is None:
+        name = 'orjson' if orjson is not None else 'json'
+    if name == 'orjson':
+        if orjson is not None:
+            return orjson.dumps, orjson.loads
+        logger.warning('json_serializer is orjson but it is not installed, '
+                       'using json')
+    return (lambda value: json.dumps(value).encode('utf-8'),
+            lambda value: json.loads(value.decode('utf-8')))
+
+
+async def init_connection(conn):
+    '''
+    json values are encoded/decoded by the driver in binary format
+    so rows come back with python objects
+    '''
+    dumps, loads = get_json_serializer()
+    await conn.set_type_codec(
+        'json', schema='pg_catalog', format='binary',
+        encoder=dumps, decoder=loads)
+    # binary jsonb is prefixed with a format version byte
+    await conn.set_type_codec(
+        'jsonb', schema='pg_catalog', format='binary',
+        encoder=lambda value: b'\x01' + dumps(value),
+        decoder=lambda value: loads(value[1:]))
+
+
+def _create_pool(db_config, dsn, loop=None):
+    # asyncpg keeps prepared statements per connection for the
+    # parameterized queries. pgbouncer in transaction mode can not
+    # use them so the cache is disabled there
+    if db_config.get('pgbouncer'):
+        statement_cache_size = 0
+    else:
+        statement_cache_size = db_config.get('statement_cache_size', 100)
+    return asyncpg.create_pool(
+        dsn=dsn,
+        loop=loop,
+        max_size=db_config.get('pool_size', 20),
+        # connections opened when the pool is created
+        min_size=db_config.get('min_size', 2),
+        statement_cache_size=statement_cache_size,
+        init=init_connection)
+
+
+class Replica:
+
+    def __init__(self, dsn, pool):
+        self.dsn = dsn
+        self.pool = pool
+        self.healthy = True
+
+
+# errors of a replica that is down or restarting, reads are retried on
+# the primary
+REPLICA_ERRORS = (
+    OSError, asyncpg.PostgresConnectionError, asyncpg.CannotConnectNowError,
+    asyncpg.InterfaceError)
+# the last replayed transaction is old when the primary is idle, there is
+# no lag when everything received was replayed
+REPLICA_LAG_SQL = '''SELECT CASE
+    WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+    ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+END'''
+
+
+async def check_replicas(replicas, max_lag=None):
+    '''
+    Mark replicas that can not be queried or lag more than `max_lag`
+    seconds behind the primary as unhealthy
+    '''
+    for replica in replicas:
+        try:
+            async with replica.pool.acquire(timeout=5) as conn:
+                lag = await conn.fetchval(REPLICA_LAG_SQL)
+            replica.healthy = (
+                max_lag is None or lag is None or lag <= max_lag)
+        except Exception:
+            logger.warning(f'Replica {replica.dsn} is not healthy',
+                           exc_info=True)
+            replica.healthy = False
+
+
+async def _check_replicas_forever(replicas, db_config):
+    while True:
+        await asyncio.sleep(db_config.get('replica_check_interval', 10))
+        await check_replicas(replicas, db_config.get('replica_max_lag'))
+
+
+def _get_request():
+    try:
+        return get_current_request()
+    except RequestNotFound:
+        return
+
+
+def mark_db_write():
+    '''
+    Reads for the rest of the request go to the primary so they
+    see what was just written
+    '''
+    request = _get_request()
+    if request is not None:
+        request._hydraidp_db_write = True
+
+
+async def _initialize_db(root, db_config, loop=None):
+    pool = await _create_pool(db_config, db_config['dsn'], loop=loop)
+    replicas = []
+    for dsn in db_config.get('replicas') or []:
+        replicas.append(Replica(
+            dsn, await _create_pool(db_config, dsn, loop=loop)))
+    setattr(root, REPLICAS_ATTR, replicas)
+    if replicas:
+        setattr(root, REPLICAS_TASK_ATTR, asyncio.ensure_future(
+            _check_replicas_forever(replicas, db_config)))
+    setattr(root, DB_ATTR, pool)
+
+
+async def get_db(loop=None, readonly=False):
     db_config = app_settings['hydra']['db']
     if db_config is None:
         return
@@ -54,14 +430,137 @@ async def get_db(loop=None):
         return
     root = get_utility(IApplication, name='root')
     if not hasattr(root, DB_ATTR):
-        setattr(root, DB_ATTR, await asyncpg.create_pool(
-            dsn=db_config['dsn'],
-            loop=loop,
-            max_size=db_config.get('pool_size', 20),
-            min_size=2))
+        # concurrent callers wait on the same initialization
+        task = getattr(root, DB_INIT_ATTR, None)
+        if task is None:
+            task = asyncio.ensure_future(
+                _initialize_db(root, db_config, loop=loop))
+            setattr(root, DB_INIT_ATTR, task)
+        try:
+            await asyncio.shield(task)
+        except Exception:
+            if getattr(root, DB_INIT_ATTR, None) is task:
+                delattr(root, DB_INIT_ATTR)
+            raise
+
+    if readonly:
+        request = _get_request()
+        if not getattr(request, '_hydraidp_db_write', False):
+            replicas = [
+                replica for replica in getattr(root, REPLICAS_ATTR)
+                if replica.healthy]
+            if replicas:
+                metrics.incr('db.reads.replica')
+                return replicas[next(_replica_counter) % len(replicas)].pool
+        metrics.incr('db.reads.primary')
     return getattr(root, DB_ATTR)
 
 
+def _get_replica(pool):
+    root = get_utility(IApplication, name='root')
+    for replica in getattr(root, REPLICAS_ATTR, []):
+        if replica.pool is pool:
+            return replica
+
+
+async def read_query(method, sql, *args):
+    '''
+    Run a read query with the `method` of the connection (fetch, fetchrow,
+    fetchval) on a replica. When the replica fails it is marked unhealthy
+    until the next check and the query runs on the primary.
+    '''
+    db = await get_db(readonly=True)
+    try:
+        async with acquire_connection(db) as conn:
+            return await getattr(conn, method)(sql, *args)
+    except REPLICA_ERRORS:
+        replica = _get_replica(db)
+        if replica is None:
+            raise
+        logger.warning(f'Replica {replica.dsn} failed, reading from primary',
+                       exc_info=True)
+        replica.healthy = False
+        metrics.incr('db.replica_failures')
+    db = await get_db()
+    async with acquire_connection(db) as conn:
+        return await getattr(conn, method)(sql, *args)
+
+
+class acquire_connection:
+    '''
+    `pool.acquire()` with the `hydra.db.acquire_timeout` setting.
+    Requests waiting longer are shed with a 503.
+    '''
+
+    in_use = 0
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.conn = None
+
+    async def __aenter__(self):
+        db_config = app_settings['hydra'].get('db') or {}
+        start = time.time()
+        try:
+            self.conn = await self.pool.acquire(
+                timeout=db_config.get('acquire_timeout', 5))
+        except asyncio.TimeoutError:
+            metrics.incr('db.acquire_timeouts')
+            raise HTTPServiceUnavailable(content={
+                'reason': 'Database busy'
+            }, headers={
+                'Retry-After': '1'
+            })
+        finally:
+            metrics.observe('db.acquire_time', time.time() - start)
+        acquire_connection.in_use += 1
+        return self.conn
+
+    async def __aexit__(self, exc_type, exc, tb):
+        acquire_connection.in_use -= 1
+        await self.pool.release(self.conn)
+
+
+def _get_idle_connections():
+    try:
+        root = get_utility(IApplication, name='root')
+        return getattr(root, DB_ATTR).get_idle_size()
+    except Exception:
+        # not initialized or older asyncpg
+        return None
+
+
+metrics.register_gauge(
+    'db.connections.in_use', lambda: acquire_connection.in_use)
+metrics.register_gauge('db.connections.idle', _get_idle_connections)
+
+
+@configure.subscriber(for_=IApplicationCleanupEvent)
+async def close_db(event):
+    root = get_utility(IApplication, name='root')
+    task = getattr(root, REPLICAS_TASK_ATTR, None)
+    if task is not None:
+        task.cancel()
+        delattr(root, REPLICAS_TASK_ATTR)
+
+    if not hasattr(root, DB_ATTR):
+        return
+    db_config = app_settings['hydra'].get('db') or {}
+    pools = [getattr(root, DB_ATTR)] + [
+        replica.pool for replica in getattr(root, REPLICAS_ATTR, [])]
+    for pool in pools:
+        try:
+            # let running queries finish before closing connections
+            await asyncio.wait_for(
+                pool.close(), db_config.get('close_timeout', 10))
+        except asyncio.TimeoutError:
+            logger.warning('Timeout closing database pool, terminating')
+            pool.terminate()
+    for attr in (DB_ATTR, DB_INIT_ATTR, REPLICAS_ATTR):
+        if hasattr(root, attr):
+            delattr(root, attr)
+
+
 async def get_conn(loop=None):
     db_config = app_settings['hydra']['db']
     if db_config is None:
@@ -95,27 +594,110 @@ async def get_csrf_cookie_str(request):
     return ''
 
 
+def _param(args, value):
+    args.append(value)
+    return Parameter('${}'.format(len(args)))
+
+
+def _filter(query, args, filters):
+    for key, value in filters.items():
+        query = query.where(
+            getattr(users_table, key) == _param(args, value)
+        )
+    return query
+
+
+def _find_user_query():
+    return Query.from_(users_table).select(
+        users_table.id, users_table.username,
+        users_table.email, users_table.phone,
+        users_table.password, users_table.data,
+        users_table.allowed_scopes
+    ).limit(1)
+
+
+# hot lookups are rendered once so the sql text is always the same
+# and the statement is only prepared once per connection
+FIND_USER_SQL = {
+    key: str(_find_user_query().where(
+        getattr(users_table, key) == Parameter('$1')))
+    for key in ('id', 'username')
+}
+# uses the lower(email) index
+FIND_USER_SQL['email'] = str(_find_user_query().where(
+    fn.Lower(users_table.email) == fn.Lower(Parameter('$1'))))
+INSERT_USER_SQL = str(Query.into(users_table).columns(*USER_COLUMNS).insert(
+    *[Parameter('${}'.format(idx + 1)) for idx in range(len(USER_COLUMNS))]))
+
+
+def get_find_user_cache():
+    '''
+    Read-through cache of `find_user` by id, username and email.
+    Returns None when disabled with a ttl of 0.
+    '''
+    global FIND_USER_CACHE
+    settings = app_settings['hydra'].get('find_user_cache') or {}
+    if not settings.get('ttl', 10):
+        return None
+    if FIND_USER_CACHE is None:
+        FIND_USER_CACHE = LRUCache(
+            'find_user_cache',
+            max_size=settings.get('size', 10000),
+            ttl=settings.get('ttl', 10))
+    return FIND_USER_CACHE
+
+
+def _get_cached_user(cache, key, value):
+    # users are stored by id, username and email point to the id and
+    # are checked against the stored user since they can change
+    userid = value if key == 'id' else cache.get((key, value), None)
+    if userid is None:
+        return None
+    user = cache.get(('id', userid), None)
+    if user is None:
+        return None
+    stored = user[key]
+    if key == 'email':
+        stored = (stored or '').lower()
+    if stored != value:
+        return None
+    return user
+
+
+def _cache_user(cache, user):
+    cache.set(('id', user['id']), user)
+    cache.set(('username', user['username']), user['id'])
+    if user['email']:
+        cache.set(('email', user['email'].lower()), user['id'])
+
+
+def invalidate_cached_user(userid):
+    global _find_user_generation
+    _find_user_generation += 1
+    cache = get_find_user_cache()
+    if cache is not None:
+        cache.delete(('id', userid))
+
+
 async def create_user(**data):
     if 'id' not in data:
         data['id'] = str(uuid.uuid4())
-    data['password'] = hash_password(data['password'], algorithm='argon2')
+    data['password'] = await hash_user_password(data['password'])
 
     if data.get('email'):
         data['email'] = data['email'].lower()
 
+    mark_db_write()
     db = await get_db()
-    query = Query.into(users_table).columns(
-        'id', 'username', 'password', 'email', 'phone',
-        'data', 'allowed_scopes')
-    query = query.insert(
-        data['id'], data['username'], data['password'],
-        data.get('email') or '',
-        data.get('phone') or '',
-        json.dumps(data.get('data') or {}),
-        json.dumps(data.get('allowed_scopes') or []),
-    )
-    async with db.acquire() as conn:
-        await conn.execute(str(query))
+    async with acquire_connection(db) as conn:
+        await conn.execute(
+            INSERT_USER_SQL,
+            data['id'], data['username'], data['password'],
+            data.get('email') or '',
+            data.get('phone') or '',
+            data.get('data') or {},
+            data.get('allowed_scopes') or [])
+    invalidate_cached_user(data['id'])
 
     await notify(UserCreatedEvent(
         data['id'],
@@ -127,111 +709,498 @@ async def create_user(**data):
     return data
 
 
-async def update_user(**data):
-    userid = data['id']
-    if data.get('password'):
-        data['password'] = hash_password(
-            data['password'], algorithm='argon2')
-
-    if data.get('email'):
-        data['email'] = data['email'].lower()
+async def create_users(users):
+    '''
+    Bulk insert users with COPY. Users conflicting with existing ones
+    are skipped. Returns lists of created and conflicting users.
+    '''
+    for data in users:
+        if 'id' not in data:
+            data['id'] = str(uuid.uuid4())
+        if data.get('email'):
+            data['email'] = data['email'].lower()
+    passwords = await hash_user_passwords(
+        [data['password'] for data in users])
+    records = []
+    for data, password in zip(users, passwords):
+        data['password'] = password
+        records.append((
+            data['id'], data['username'], data['password'],
+            # NULL, the email column is unique
+            data.get('email') or None,
+            data.get('phone') or '',
+            data.get('data') or {},
+            data.get('allowed_scopes') or []))
 
+    mark_db_write()
     db = await get_db()
-    query = Query.update(users_table).where(
-        users_table.id == userid
-    )
-    for key, value in data.items():
-        if key in ('id', '@id'):
+    async with acquire_connection(db) as conn:
+        async with conn.transaction():
+            # COPY can not skip conflicts, load into a temporary table first
+            await conn.execute(
+                'CREATE TEMPORARY TABLE hydra_users_import '
+                '(LIKE hydra_users) ON COMMIT DROP')
+            await conn.copy_records_to_table(
+                'hydra_users_import', records=records, columns=USER_COLUMNS)
+            columns = ', '.join(USER_COLUMNS)
+            rows = await conn.fetch(
+                f'INSERT INTO hydra_users ({columns}) '
+                f'SELECT {columns} FROM hydra_users_import '
+                f'ON CONFLICT DO NOTHING RETURNING id')
+
+    created_ids = set(row['id'] for row in rows)
+    created = []
+    conflicts = []
+    for data in users:
+        if data['id'] in created_ids:
+            created_ids.remove(data['id'])
+            created.append(data)
+        else:
+            conflicts.append(data)
+
+    for data in created:
+        invalidate_cached_user(data['id'])
+    # the events of a batch are notified together
+    await asyncio.gather(*[
+        notify(UserCreatedEvent(
+            data['id'],
+            data.get('email', ''),
+            data['username'],
+            data.get('data', {}),
+            data.get('allowed_scopes', [])
+        )) for data in created])
+    return created, conflicts
+
+
+async def import_users(lines, batch_size=500):
+    '''
+    Import users from an async iterable of ndjson lines in batches.
+    Returns the number of created users and errors per line.
+    '''
+    schema = app_settings['json_schema_definitions']['HydraUser']
+    result = {
+        'created': 0,
+        'errors': []
+    }
+
+    async def _flush(batch):
+        created, conflicts = await create_users(
+            [data for _, data in batch])
+        result['created'] += len(created)
+        conflicting = set(id(data) for data in conflicts)
+        for lineno, data in batch:
+            if id(data) in conflicting:
+                result['errors'].append({
+                    'line': lineno,
+                    'id': data['id'],
+                    'username': data['username'],
+                    'reason': 'user already exists'
+                })
+
+    batch = []
+    lineno = 0
+    async for line in lines:
+        lineno += 1
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        if not line.strip():
             continue
-        if key in ('data', 'allowed_scopes'):
-            value = json.dumps(value)
         try:
-            query = query.set(getattr(users_table, key), value)
-        except AttributeError:
-            pass
-    async with db.acquire() as conn:
-        await conn.execute(str(query))
+            data = json.loads(line)
+            jsonschema.validate(data, schema)
+        except (ValueError, jsonschema.ValidationError) as e:
+            result['errors'].append({
+                'line': lineno,
+                'reason': getattr(e, 'message', str(e))
+            })
+            continue
+        batch.append((lineno, data))
+        if len(batch) >= batch_size:
+            await _flush(batch)
+            batch = []
+    if batch:
+        await _flush(batch)
+    return result
 
-    await notify(UserModifiedEvent(userid, data))
-    return data
+
+async def update_user(**data):
+    '''
+    Replace the given columns, returns the stored user or None if it
+    does not exist
+    '''
+    userid = data.pop('id')
+    columns = {key: data[key] for key in USER_COLUMNS if key in data}
+    return await patch_user(userid, columns, merge=False)
+
+
+USER_RETURNING = ' RETURNING id, username, email, phone, data, ' \
+                 'allowed_scopes'
+PATCH_COLUMNS = tuple(
+    column for column in USER_COLUMNS if column not in ('id', 'data'))
+
+
+def build_patch_query(userid, fields, data=None, add_scopes=None,
+                      remove_scopes=None, merge=True):
+    '''
+    One UPDATE for a partial change, `fields` are the PATCH_COLUMNS
+    values to set. With `merge`, `data` is a json merge
+    patch (RFC 7396) applied by hydra_jsonb_merge_patch, null values
+    remove keys, otherwise it replaces the column. Scopes are removed,
+    then added if not already present. When scopes or username change,
+    the previous values are returned as `previous_scopes` and
+    `previous_username`.
+    '''
+    args = [userid]
+
+    def param(value):
+        args.append(value)
+        return '${}'.format(len(args))
+
+    sets = []
+    for key, value in fields.items():
+        if key != 'allowed_scopes':
+            sets.append(f'{key} = {param(value)}')
+    if data and merge:
+        sets.append(
+            f"data = hydra_jsonb_merge_patch(data, {param(data)}::jsonb)")
+    elif data is not None and not merge:
+        sets.append(f'data = {param(data)}::jsonb')
+
+    scopes = "COALESCE(allowed_scopes, '[]'::jsonb)"
+    if 'allowed_scopes' in fields:
+        scopes = f"{param(fields['allowed_scopes'] or [])}::jsonb"
+    if remove_scopes:
+        scopes = f'({scopes} - {param(list(remove_scopes))}::text[])'
+    if add_scopes:
+        scopes = (
+            f'({scopes} || (SELECT COALESCE(jsonb_agg(DISTINCT scope), '
+            f"'[]'::jsonb) FROM jsonb_array_elements("
+            f'{param(list(add_scopes))}::jsonb) scope '
+            f'WHERE NOT {scopes} @> jsonb_build_array(scope)))')
+    scopes_changed = 'allowed_scopes' in fields or remove_scopes or add_scopes
+    if scopes_changed:
+        sets.append(f'allowed_scopes = {scopes}')
+
+    if not sets:
+        return None, args
+    sql = f'UPDATE hydra_users SET {", ".join(sets)}'
+    returning = USER_RETURNING
+    if scopes_changed or 'username' in fields:
+        # the locked row before the update, in the same statement
+        sql += " FROM (SELECT COALESCE(allowed_scopes, '[]'::jsonb) " \
+               "AS previous_scopes, username AS previous_username " \
+               "FROM hydra_users WHERE id = $1 FOR UPDATE) previous"
+        returning += ', previous_scopes, previous_username'
+    return sql + ' WHERE id = $1' + returning, args
+
+
+async def patch_user(userid, changes, merge=True):
+    '''
+    Apply a partial update in a single statement, see `build_patch_query`.
+    `changes` is the request body, only user columns, `add_scopes` and
+    `remove_scopes` are used from it. Returns the updated user without
+    password, None if it does not exist.
+    '''
+    fields = {
+        key: changes[key] for key in PATCH_COLUMNS if key in changes}
+    if fields.get('password'):
+        fields['password'] = await hash_user_password(fields['password'])
+    if fields.get('email'):
+        fields['email'] = fields['email'].lower()
+
+    sql, args = build_patch_query(
+        userid, fields,
+        data=changes.get('data'),
+        add_scopes=changes.get('add_scopes'),
+        remove_scopes=changes.get('remove_scopes'),
+        merge=merge)
+    if sql is None:
+        user = await find_user(id=userid)
+        if user is not None:
+            del user['password']
+        return user
+
+    mark_db_write()
+    db = await get_db()
+    async with acquire_connection(db) as conn:
+        row = await conn.fetchrow(sql, *args)
+    invalidate_cached_user(userid)
+    if row is None:
+        return None
+    user = dict(row)
+    previous_scopes = user.pop('previous_scopes', None)
+    previous_username = user.pop('previous_username', None)
+    await notify(UserModifiedEvent(
+        userid, user, previous_scopes, previous_username))
+    return user
+
+
+async def record_login(userid, pw=None):
+    '''
+    Set last_login when the cache warmup is enabled, it loads recently
+    active users. With `pw` the stored hash is upgraded to the configured
+    argon2 parameters in the same statement. Does not notify modification
+    since the password did not change.
+    '''
+    sets = []
+    args = [userid]
+    if (app_settings['hydra'].get('warmup') or {}).get('enabled'):
+        sets.append('last_login = now()')
+    if pw is not None:
+        args.append(await hash_user_password(pw))
+        sets.append('password = $2')
+    if not sets:
+        return
+    mark_db_write()
+    db = await get_db()
+    async with acquire_connection(db) as conn:
+        await conn.execute(
+            f'UPDATE hydra_users SET {", ".join(sets)} WHERE id = $1', *args)
+    if pw is not None:
+        invalidate_cached_user(userid)
+
+
+REMOVE_USER_SQL = {
+    key: f'DELETE FROM hydra_users WHERE {key} = $1 '
+         f'RETURNING id, username, allowed_scopes'
+    for key in ('id', 'username')
+}
 
 
 async def remove_user(user_id=None, username=None):
+    '''
+    Returns the removed user id, username and allowed_scopes, None if it
+    did not exist
+    '''
     if user_id is not None:
-        query = Query.from_(users_table).where(
-            users_table.id == user_id
-        )
+        sql, value = REMOVE_USER_SQL['id'], user_id
     else:
-        query = Query.from_(users_table).where(
-            users_table.username == username
-        )
+        sql, value = REMOVE_USER_SQL['username'], username
+    mark_db_write()
     db = await get_db()
-    async with db.acquire() as conn:
-        await conn.execute(str(query.delete()))
-    await notify(UserRemovedEvent(user_id, username))
+    async with acquire_connection(db) as conn:
+        row = await conn.fetchrow(sql, value)
+    if row is None:
+        return None
+    invalidate_cached_user(row['id'])
+    await notify(UserRemovedEvent(
+        row['id'], row['username'], row['allowed_scopes']))
+    return dict(row)
 
 
-async def find_users(limit=1000, **filters):
+async def find_users(limit=MAX_PAGE_SIZE, cursor=None, **filters):
+    '''
+    Page through users ordered by id. `cursor` is the last id of the
+    previous page.
+    '''
+    args = []
     query = Query.from_(users_table).select(
-        users_table.id, users_table.username).limit(1000)
-    for key, value in filters.items():
-        query = query.where(
-            getattr(users_table, key) == value
-        )
+        users_table.id, users_table.username
+    ).orderby(users_table.id).limit(min(limit, MAX_PAGE_SIZE))
+    if cursor is not None:
+        query = query.where(users_table.id > _param(args, cursor))
+    query = _filter(query, args, filters)
+    return await read_query('fetch', str(query), *args)
+
+
+def _like_pattern(value, match):
+    value = value.replace('\\', '\\\\').replace(
+        '%', '\\%').replace('_', '\\_')
+    if match == 'contains':
+        return f'%{value}%'
+    return f'{value}%'
+
+
+def build_search_query(scopes=None, data=None, username=None, email=None,
+                       match='prefix', limit=100, cursor=None):
+    '''
+    jsonb containment and trigram searches are not supported by pypika,
+    the sql is built by hand with parameters for all values
+    '''
+    args = []
+    where = []
+
+    def param(value):
+        args.append(value)
+        return '${}'.format(len(args))
+
+    if scopes:
+        # uses user_gin_idx
+        where.append(f'allowed_scopes @> {param(scopes)}')
+    if data:
+        # uses user_data_gin_idx
+        where.append(f'data @> {param(data)}')
+    if username:
+        # uses user_username_trgm
+        where.append(
+            f'username ILIKE {param(_like_pattern(username, match))}')
+    if email:
+        # uses user_email_trgm
+        where.append(
+            f'lower(email) LIKE {param(_like_pattern(email.lower(), match))}')
+    if cursor:
+        where.append(f'id > {param(cursor)}')
+    sql = 'SELECT id, username, email, phone, data, allowed_scopes ' \
+          'FROM hydra_users'
+    if where:
+        sql += ' WHERE ' + ' AND '.join(where)
+    sql += f' ORDER BY id LIMIT {param(min(limit, MAX_PAGE_SIZE))}'
+    return sql, args
+
+
+async def search_users(**criteria):
+    sql, args = build_search_query(**criteria)
+    return await read_query('fetch', sql, *args)
+
+
+async def iter_users(columns=('id', 'username'), batch_size=500, **filters):
+    '''
+    Iterate all users with a server side cursor, only `batch_size`
+    rows are in memory at a time. Runs on the primary: a replica can cancel
+    long queries on replication conflicts and a stream can not be retried
+    once rows were sent.
+    '''
+    args = []
+    query = Query.from_(users_table).select(
+        *[getattr(users_table, column) for column in columns]
+    ).orderby(users_table.id)
+    query = _filter(query, args, filters)
     db = await get_db()
-    async with db.acquire() as conn:
-        return await conn.fetch(str(query))
+    async with acquire_connection(db) as conn:
+        async with conn.transaction():
+            async for row in conn.cursor(
+                    str(query), *args, prefetch=batch_size):
+                yield row
 
 
-async def find_user(**filters):
+async def copy_users(output, columns=USER_COLUMNS, format='csv'):
+    '''
+    COPY users to `output`, a coroutine function called with each chunk
+    of data. Awaiting it on a response writer applies backpressure.
+    Runs on the primary like `iter_users`.
+    '''
     query = Query.from_(users_table).select(
-        users_table.id, users_table.username,
-        users_table.email, users_table.phone,
-        users_table.password, users_table.data,
-        users_table.allowed_scopes
-    ).limit(1)
-    for key, value in filters.items():
-        query = query.where(
-            getattr(users_table, key) == value
-        )
+        *[getattr(users_table, column) for column in columns]
+    ).orderby(users_table.id)
     db = await get_db()
-    async with db.acquire() as conn:
-        result = await conn.fetch(str(query))
-        if len(result) > 0:
-            data = dict(result[0])
-            data['data'] = json.loads(data['data'])
-            data['allowed_scopes'] = json.loads(data['allowed_scopes'])
-            return data
+    async with acquire_connection(db) as conn:
+        await conn.copy_from_query(
+            str(query), output=output, format=format, header=True)
+
+
+FIND_USERS_BY_IDS_SQL = 'SELECT id, username, email, phone, data, ' \
+                        'allowed_scopes FROM hydra_users ' \
+                        'WHERE id = ANY($1::varchar[])'
+
+
+async def find_users_by_ids(ids):
+    '''
+    Look up many users in one query. Returns the found users in the
+    order of `ids` and the ids that do not exist.
+    '''
+    ids = list(dict.fromkeys(ids))
+    rows = await read_query('fetch', FIND_USERS_BY_IDS_SQL, ids)
+    found = {row['id']: dict(row) for row in rows}
+    users = [found[userid] for userid in ids if userid in found]
+    missing = [userid for userid in ids if userid not in found]
+    return users, missing
+
+
+async def find_user(primary=False, **filters):
+    '''
+    Single id, username or email lookups are cached per worker. With
+    `primary` the cache and replicas are skipped, for callers that keep
+    the result longer than the cache ttl, the row read refreshes the cache.
+    '''
+    cache = None
+    if len(filters) == 1 and list(filters)[0] in FIND_USER_SQL:
+        key, value = list(filters.items())[0]
+        sql = FIND_USER_SQL[key]
+        args = [value]
+        cache = get_find_user_cache()
+    else:
+        args = []
+        sql = str(_filter(_find_user_query(), args, filters))
+
+    if cache is not None and not primary:
+        if key == 'email':
+            value = value.lower()
+        user = _get_cached_user(cache, key, value)
+        if user is not None:
+            metrics.incr('find_user.hits')
+            return dict(user)
+        metrics.incr('find_user.misses')
+
+    generation = _find_user_generation
+    if primary:
+        db = await get_db()
+        async with acquire_connection(db) as conn:
+            row = await conn.fetchrow(sql, *args)
+    else:
+        row = await read_query('fetchrow', sql, *args)
+    if row is None:
+        return None
+    user = dict(row)
+    if cache is not None and generation == _find_user_generation:
+        _cache_user(cache, user)
+        # callers can change the returned dict
+        return dict(user)
+    return user
 
 
 async def validate_recaptcha(recaptcha_response):
-    async with aiohttp.ClientSession() as session:
-        async with await session.post(
-            "https://www.google.com/recaptcha/api/siteverify",
-            data=dict(
-                secret=app_settings["recaptcha"]["private"],
-                response=recaptcha_response,
-            ),
-        ) as resp:
-            try:
-                data = await resp.json()
-            except Exception:  # pragma: no cover
-                logger.warning("Did not get json response", exc_info=True)
-                return
-            try:
-                return data["success"]
-            except Exception:  # pragma: no cover
-                return False
+    session = get_http_session()
+    async with session.post(
+        "https://www.google.com/recaptcha/api/siteverify",
+        data=dict(
+            secret=app_settings["recaptcha"]["private"],
+            response=recaptcha_response,
+        ),
+    ) as resp:
+        try:
+            data = await resp.json()
+        except Exception:  # pragma: no cover
+            logger.warning("Did not get json response", exc_info=True)
+            return
+        try:
+            return data["success"]
+        except Exception:  # pragma: no cover
+            return False
+
+
+def get_registration_keyring():
+    '''
+    Private keys join payloads are encrypted for, `registration_key` is
+    one pem or a list of them
+    '''
+    global REGISTRATION_KEYRING
+    if REGISTRATION_KEYRING is None:
+        pems = app_settings.get('registration_key') or []
+        if not isinstance(pems, list):
+            pems = [pems]
+        REGISTRATION_KEYRING = Keyring.from_settings(
+            [{'priv': pem} for pem in pems])
+    return REGISTRATION_KEYRING
+
+
+def get_internal_keyring():
+    '''
+    Keys for internal payloads from `internal_keys`, falling back to the
+    single `internal_key`
+    '''
+    global INTERNAL_KEYRING
+    if INTERNAL_KEYRING is None:
+        keys = app_settings.get('internal_keys')
+        if not keys and app_settings.get('internal_key'):
+            keys = [app_settings['internal_key']]
+        INTERNAL_KEYRING = Keyring.from_settings(keys)
+    return INTERNAL_KEYRING
 
 
 def validate_payload(payload):
-    global REGISTRATION_KEY
-    if REGISTRATION_KEY is None and app_settings['registration_key']:
-        REGISTRATION_KEY = jwk.JWK.from_pem(app_settings['registration_key'])  # Priv Key
     try:
-        jwetoken = jwe.JWE()
-        jwetoken.deserialize(payload.decode('utf-8'), key=REGISTRATION_KEY)
-        return json.loads(jwetoken.payload)
+        return json.loads(
+            get_registration_keyring().decrypt(payload.decode('utf-8')))
     except jwe.InvalidJWEOperation:
         # expired token
         logger.warn(f'Invalid operation', exc_info=True)
@@ -242,17 +1211,7 @@ def validate_payload(payload):
 
 
 def encrypt_internal_payload(payload):
-    global PUB_INTERNAL_KEY
-    if PUB_INTERNAL_KEY is None and app_settings['internal_key']['pub']:
-        PUB_INTERNAL_KEY = jwk.JWK.from_pem(
-            app_settings['internal_key']['pub'])
     try:
-        protected_header = {
-            "alg": "RSA-OAEP-256",
-            "enc": "A256CBC-HS512",
-            "typ": "JWE",
-            "kid": PUB_INTERNAL_KEY.thumbprint(),
-        }
         if isinstance(payload, dict):
             payload['_timestamp'] = datetime.datetime.utcnow().isoformat()
             payload = json.dumps(payload)
@@ -260,11 +1219,7 @@ def encrypt_internal_payload(payload):
             data = json.loads(payload)
             data['_timestamp'] = datetime.datetime.utcnow().isoformat()
             payload = json.dumps(data)
-        jwetoken = jwe.JWE(
-            payload.encode('utf-8'),
-            recipient=PUB_INTERNAL_KEY,
-            protected=protected_header)
-        return jwetoken.serialize(compact=True)
+        return get_internal_keyring().encrypt(payload.encode('utf-8'))
     except jwe.InvalidJWEOperation:
         # expired token
         logger.warn(f'Invalid operation on jwe encrypt', exc_info=True)
@@ -275,19 +1230,12 @@ def encrypt_internal_payload(payload):
 
 
 def decrypt_internal_payload(payload):
-    global PRIV_INTERNAL_KEY
-    if PRIV_INTERNAL_KEY is None and app_settings['internal_key']['priv']:
-        PRIV_INTERNAL_KEY = jwk.JWK.from_pem(
-            app_settings['internal_key']['priv'])
     try:
-        jwetoken = jwe.JWE()
-        jwetoken.deserialize(payload, key=PRIV_INTERNAL_KEY)
-        return json.loads(jwetoken.payload)
-
+        return json.loads(get_internal_keyring().decrypt(payload))
     except jwe.InvalidJWEOperation:
         # expired token
         logger.warn(f'Invalid operation on jwe decrypt', exc_info=True)
         return
     except jwe.InvalidJWEData:
         logger.warn(f'Error decrypting JWT token', exc_info=True)
-        return
\ No newline at end of file
+        return
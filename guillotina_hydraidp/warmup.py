@@ -0,0 +1,140 @@
+'''
+Fill the identifier cache on startup so a deploy does not send the first
+request of every active user to postgres at once.
+
+Users come from the snapshot of cached logins written at shutdown when
+`hydra.warmup.snapshot` is set, otherwise the most recent logins are used.
+Warmup runs in the background and stops after `time_budget` seconds.
+'''
+import asyncio
+import json
+import logging
+import os
+import time
+
+from guillotina import app_settings, configure
+from guillotina.interfaces import IApplicationCleanupEvent
+from guillotina_hydraidp import identifier
+from guillotina_hydraidp import metrics
+from guillotina_hydraidp import utils
+from guillotina_rediscache import cache
+
+logger = logging.getLogger(__name__)
+
+WARMUP_TASK_ATTR = '_hydraidp_warmup_task'
+RECENT_LOGINS_SQL = 'SELECT username FROM hydra_users ' \
+                    'WHERE last_login IS NOT NULL ' \
+                    'ORDER BY last_login DESC NULLS LAST LIMIT $1'
+USERS_BY_LOGIN_SQL = 'SELECT username, allowed_scopes FROM hydra_users ' \
+                     'WHERE username = ANY($1::varchar[])'
+
+
+def get_warmup_settings():
+    return app_settings['hydra'].get('warmup') or {}
+
+
+def get_cached_logins():
+    '''
+    Logins in the identifier cache of this worker
+    '''
+    prefix = 'hydra-user-'
+    logins = []
+    for key in cache.get_memory_cache().keys():
+        if isinstance(key, str) and key.startswith(prefix):
+            logins.append(key[len(prefix):].rsplit('-', 1)[0])
+    return list(dict.fromkeys(logins))
+
+
+def read_snapshot(filename):
+    try:
+        with open(filename) as fi:
+            return json.load(fi)
+    except FileNotFoundError:
+        return None
+    except ValueError:
+        logger.warning(f'Invalid user cache snapshot {filename}')
+        return None
+
+
+def write_snapshot(filename, logins):
+    # rename so workers never read a partial file
+    tmp_filename = f'{filename}.{os.getpid()}'
+    with open(tmp_filename, 'w') as fi:
+        json.dump(logins, fi)
+    os.replace(tmp_filename, filename)
+
+
+async def get_warmup_logins(size):
+    settings = get_warmup_settings()
+    if settings.get('snapshot'):
+        logins = read_snapshot(settings['snapshot'])
+        if logins:
+            return logins[:size]
+    rows = await utils.read_query('fetch', RECENT_LOGINS_SQL, size)
+    return [row['username'] for row in rows]
+
+
+async def warmup_user_cache(size=1000, batch_size=200):
+    '''
+    Load users into the identifier cache, one query per batch
+    '''
+    start = time.time()
+    store = cache.get_memory_cache()
+    logins = await get_warmup_logins(size)
+    loaded = 0
+    for idx in range(0, len(logins), batch_size):
+        invalidations = identifier._invalidations
+        rows = await utils.read_query(
+            'fetch', USERS_BY_LOGIN_SQL, logins[idx:idx + batch_size])
+        if invalidations != identifier._invalidations:
+            # users changed while loading, they are looked up on use
+            continue
+        for row in rows:
+            key = identifier.get_user_cache_key(row['username'])
+            if key not in store:
+                store[key] = identifier.CachedUser.from_user_data(row)
+                loaded += 1
+        metrics.incr('warmup.users', len(rows))
+    metrics.observe('warmup.time', time.time() - start)
+    return loaded
+
+
+async def _run_warmup():
+    settings = get_warmup_settings()
+    budget = settings.get('time_budget', 10)
+    try:
+        loaded = await asyncio.wait_for(warmup_user_cache(
+            size=settings.get('users', 1000),
+            batch_size=settings.get('batch_size', 200)), budget)
+        logger.info(f'Warmed up user cache with {loaded} users')
+    except asyncio.TimeoutError:
+        logger.warning(f'User cache warmup stopped after {budget} seconds')
+    except asyncio.CancelledError:
+        pass
+    except Exception:
+        logger.warning('Error warming up user cache', exc_info=True)
+
+
+def start_warmup(app):
+    '''
+    Called once migrations ran, startup does not wait for it
+    '''
+    if not get_warmup_settings().get('enabled'):
+        return
+    setattr(app, WARMUP_TASK_ATTR, asyncio.ensure_future(_run_warmup()))
+
+
+@configure.subscriber(for_=IApplicationCleanupEvent)
+async def finish_warmup(event):
+    task = getattr(event.app, WARMUP_TASK_ATTR, None)
+    if task is not None and not task.done():
+        task.cancel()
+
+    settings = get_warmup_settings()
+    if settings.get('enabled') and settings.get('snapshot'):
+        logins = get_cached_logins()[:settings.get('users', 1000)]
+        try:
+            write_snapshot(settings['snapshot'], logins)
+        except OSError:
+            logger.warning('Could not write user cache snapshot',
+                           exc_info=True)
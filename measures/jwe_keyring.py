@@ -0,0 +1,75 @@
+'''
+Measure internal payload encrypt/decrypt operations per second with a
+single key whose thumbprint is computed on every encrypt (how payloads
+were encrypted before), trying every key of a rotation in turn, and the
+kid indexed keyring.
+
+Usage::
+
+    python measures/jwe_keyring.py
+'''
+from guillotina_hydraidp.keyring import Keyring
+from jwcrypto import jwe
+from jwcrypto import jwk
+
+import time
+
+
+KEYS = 5
+ITERATIONS = 500
+PAYLOAD = b'{"username": "foobar", "email": "foobar@foobar.com"}'
+
+# ----------------------------------------------------
+# Measure performance of internal payload encryption
+#
+# Lessons:
+#   - thumbprint() hashes the key on every encrypt
+#   - RSA decryption dominates, trying keys in turn costs one RSA
+#     operation per key tried while the kid selects the right one
+# ----------------------------------------------------
+
+
+def single_key_encrypt(key):
+    token = jwe.JWE(PAYLOAD, recipient=key, protected={
+        'alg': Keyring.alg,
+        'enc': Keyring.enc,
+        'typ': 'JWE',
+        'kid': key.thumbprint(),
+    })
+    return token.serialize(compact=True)
+
+
+def try_all_keys_decrypt(keys, payload):
+    for key in keys:
+        token = jwe.JWE()
+        token.deserialize(payload)
+        try:
+            token.decrypt(key)
+            return token.payload
+        except jwe.InvalidJWEData:
+            pass
+
+
+def measure(name, func, *args):
+    start = time.time()
+    for _ in range(ITERATIONS):
+        func(*args)
+    end = time.time()
+    print(f'{name}: {ITERATIONS / (end - start):.0f} ops/sec')
+
+
+def run():
+    keys = [jwk.JWK.generate(kty='RSA', size=2048) for _ in range(KEYS)]
+    keyring = Keyring(keys)
+    # the oldest key of the rotation
+    payload = Keyring([keys[-1]]).encrypt(PAYLOAD)
+
+    measure('encrypt single key', single_key_encrypt, keys[0])
+    measure('encrypt keyring', keyring.encrypt, PAYLOAD)
+    measure(f'decrypt trying {KEYS} keys', try_all_keys_decrypt,
+            keys, payload)
+    measure('decrypt keyring', keyring.decrypt, payload)
+
+
+if __name__ == '__main__':
+    run()
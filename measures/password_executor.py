@@ -0,0 +1,77 @@
+'''
+Measure login throughput and latency of unrelated work on the loop
+while many argon2 verifications are running concurrently.
+
+Usage::
+
+    python measures/password_executor.py
+'''
+from guillotina import app_settings
+from guillotina_hydraidp import utils
+
+import asyncio
+import time
+
+
+CONCURRENT_LOGINS = 50
+ITERATIONS = 4
+TICK = 0.005
+
+# ----------------------------------------------------
+# Measure performance of password verification executors
+#
+# Lessons:
+#   - inline verification stalls every other coroutine for the full
+#     duration of each argon2 verify
+#   - argon2 releases the GIL so a thread pool keeps the loop responsive
+#     without the pickling overhead of a process pool
+# ----------------------------------------------------
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct))]
+
+
+async def ticker(latencies, done):
+    # unrelated request: should wake up every TICK seconds
+    while not done.is_set():
+        start = time.time()
+        await asyncio.sleep(TICK)
+        latencies.append(time.time() - start - TICK)
+
+
+async def run_mode(mode, token):
+    app_settings['hydra']['password_executor'] = mode
+    utils.PASSWORD_EXECUTOR = None
+    latencies = []
+    done = asyncio.Event()
+    tick_task = asyncio.ensure_future(ticker(latencies, done))
+    start = time.time()
+    for _ in range(ITERATIONS):
+        await asyncio.gather(*[
+            utils.check_user_password(token, 'foobar')
+            for _ in range(CONCURRENT_LOGINS)])
+    end = time.time()
+    done.set()
+    await tick_task
+    if utils.PASSWORD_EXECUTOR is not None:
+        utils.PASSWORD_EXECUTOR.shutdown()
+
+    total = CONCURRENT_LOGINS * ITERATIONS
+    print(f'{mode}: {total / (end - start):.1f} logins/sec, '
+          f'loop lag p50 {percentile(latencies, 0.5) * 1000:.2f}ms, '
+          f'p99 {percentile(latencies, 0.99) * 1000:.2f}ms')
+
+
+async def run():
+    app_settings['hydra'] = {
+        'password_executor_size': None
+    }
+    token = utils.hash_argon2_password('foobar')
+    for mode in ('inline', 'thread', 'process'):
+        await run_mode(mode, token)
+
+
+if __name__ == '__main__':
+    asyncio.get_event_loop().run_until_complete(run())
@@ -35,6 +35,9 @@ setup(
         'test': [
             'pytest',
             'aioresponses'
+        ],
+        'orjson': [
+            'orjson'
         ]
     },
     classifiers=[],